@@ -0,0 +1,112 @@
+# Generators for synthetic dllup corpora used by the benchmarks.
+#
+# Every generator is deterministic for a given size so that timings are
+# comparable between runs and against the stored baseline.
+
+import random
+from pathlib import Path
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog lidar point cloud robot "
+    "calibration kalman filter graph optimization camera pose estimate"
+).split()
+
+
+def sentence(rng, n=12):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def inline_text(rng, n=12):
+    # A sentence sprinkled with every kind of inline markup.
+    s = sentence(rng, n)
+    return (
+        f'{s} _{rng.choice(WORDS)}_ **{rng.choice(WORDS)}** "{rng.choice(WORDS)}" '
+        f"`{rng.choice(WORDS)}()` ${rng.choice('xyz')}_{rng.randint(0, 9)}$ "
+        f"[{rng.choice(WORDS)}](/{rng.choice(WORDS)}/) it's -- fine..."
+    )
+
+
+def document(body, title="Synthetic document"):
+    return f"{title}\nsubtitle\n\nIntroduction paragraph.\n===\n\n{body}\n"
+
+
+def deep_headers(n=2000, seed=0):
+    # Many headers nested up to six levels, each followed by a paragraph.
+    rng = random.Random(seed)
+    blocks = []
+    level = 1
+    for _ in range(n):
+        level = max(1, min(6, level + rng.choice((-1, 0, 1))))
+        blocks.append("#" * level + " " + sentence(rng, 4))
+        blocks.append(sentence(rng))
+    return document("\n\n".join(blocks))
+
+
+def huge_table(rows=20000, cols=6, seed=0):
+    # One table of mostly plain cells with the occasional piece of markup.
+    rng = random.Random(seed)
+    lines = ["| " + " | ".join(f"Column {c}" for c in range(cols)) + " |"]
+    lines.append("|" + "---|" * cols)
+    for r in range(rows):
+        cells = [str(rng.randint(0, 10**6)) for _ in range(cols - 1)]
+        cells.append(f"_{rng.choice(WORDS)}_" if r % 10 == 0 else rng.choice(WORDS))
+        lines.append("| " + " | ".join(cells) + " |")
+    lines.append("A synthetic table")
+    return document("\n".join(lines))
+
+
+def nested_lists(n=300, depth=5, seed=0):
+    # Many bullet lists, each nested several levels deep, plus numbered lists.
+    rng = random.Random(seed)
+    blocks = []
+    for _ in range(n):
+        items = []
+        for d in range(1, depth + 1):
+            for _ in range(3):
+                items.append("*" * d + " " + inline_text(rng, 6))
+        blocks.append("\n".join(items))
+        blocks.append("\n".join(f"{i}. {sentence(rng, 6)}" for i in range(1, 6)))
+    return document("\n\n".join(blocks))
+
+
+def inline_spans(n=3000, seed=0):
+    # Paragraphs dense with inline math, code, emphasis and links.
+    rng = random.Random(seed)
+    return document("\n\n".join(inline_text(rng) for _ in range(n)))
+
+
+CORPORA = {
+    "deep_headers": deep_headers,
+    "huge_table": huge_table,
+    "nested_lists": nested_lists,
+    "inline_spans": inline_spans,
+}
+
+
+def blog_tree(root: Path, posts=2000, seed=0):
+    # Writes a site with a root index, a blog of yYYYYmMMdDD posts and the
+    # html templates and stylesheets copied from the repository.
+    rng = random.Random(seed)
+    repo = Path(__file__).resolve().parent.parent
+    for d in ("html", "css"):
+        (root / d).mkdir(parents=True, exist_ok=True)
+        for f in (repo / d).iterdir():
+            (root / d / f.name).write_text(f.read_text())
+    (root / "texcache").mkdir(exist_ok=True)
+    (root / "config").write_text("type root\n")
+    (root / "index.dllu").write_text(document(inline_text(rng), "Home"))
+    blog = root / "blog"
+    blog.mkdir(exist_ok=True)
+    (blog / "config").write_text("type blogposts\n")
+    (blog / "index.dllu").write_text(document("All posts.", "Blog"))
+    for i in range(posts):
+        year = 2000 + i // 336
+        month = 1 + i // 28 % 12
+        day = 1 + i % 28
+        post = blog / f"y{year:04d}m{month:02d}d{day:02d}"
+        post.mkdir(exist_ok=True)
+        body = "\n\n".join(
+            ["# " + sentence(rng, 3), inline_text(rng), "## " + sentence(rng, 3)]
+            + [sentence(rng, 30) for _ in range(5)]
+        )
+        (post / "index.dllu").write_text(document(body, sentence(rng, 5)))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Benchmarks for the dllup parsers and the site builder.
+#
+# Measures dllup.parse and dlluptex.parse throughput on synthetic corpora and
+# end-to-end build time on a synthetic blog, then compares the results to a
+# stored baseline. External tools (tex2svg, sass) are replaced by stubs so
+# that the benchmarks run offline and only measure our own code.
+#
+#     bench/run.py            run and compare against bench/baseline.json
+#     bench/run.py --save     run and store the results as the new baseline
+#     bench/run.py --quick    run on corpora a tenth of the usual size, against
+#                             bench/baseline-quick.json
+#
+# A baseline records the scale it was measured at, and results are never
+# compared to or saved over a baseline of another scale.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH.parent))
+
+import corpus  # noqa: E402
+
+SIZES = {
+    "deep_headers": {"n": 2000},
+    "huge_table": {"rows": 20000},
+    "nested_lists": {"n": 300},
+    "inline_spans": {"n": 3000},
+}
+BLOG_POSTS = 2000
+
+STUBS = {
+    # prints a small, fixed svg in the shape that mathjax produces
+    "tex2svg": """
+print(
+    '<svg style="vertical-align: -0.5ex;" xmlns="http://www.w3.org/2000/svg" '
+    'width="2ex" height="1ex" viewBox="0 -500 1000 1000">'
+    '<defs><path id="MJX-1-TEX-I-1D465" d="M0 0L1 1"></path></defs>'
+    '<g><use xlink:href="#MJX-1-TEX-I-1D465"></use></g></svg>'
+)
+""",
+    # sass -s compressed <in> <out>
+    "sass": """
+open(sys.argv[-1], "w").close()
+""",
+}
+
+
+def install_stubs(bindir: Path):
+    for name, body in STUBS.items():
+        stub = bindir / name
+        stub.write_text(f"#!{sys.executable}\nimport sys\n{body}")
+        stub.chmod(0o755)
+    os.environ["PATH"] = f"{bindir}{os.pathsep}{os.environ['PATH']}"
+
+
+def best_of(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_parsers(results, scale, repeat):
+    import dllup
+    import dlluptex
+
+    for name, generator in corpus.CORPORA.items():
+        markup = generator(
+            **{k: max(1, int(v * scale)) for k, v in SIZES[name].items()}
+        )
+        mb = len(markup.encode("utf-8")) / 1e6
+        for module in (dllup, dlluptex):
+            # warm up so that the math cache is populated
+            module.parse(markup)
+            seconds = best_of(lambda: module.parse(markup), repeat)
+            results[f"{module.__name__}.parse/{name}"] = {
+                "value": mb / seconds,
+                "unit": "MB/s",
+            }
+
+
+def bench_build(results, scale):
+    import build
+
+    site = Path.cwd() / "site"
+    corpus.blog_tree(site, max(1, int(BLOG_POSTS * scale)))
+    os.chdir(site)
+    sys.argv = ["build.py"]
+    try:
+        for name in ("cold", "warm"):
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds = best_of(build.main, 1)
+            results[f"build.main/{name}"] = {"value": seconds, "unit": "s"}
+    finally:
+        os.chdir(site.parent)
+
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    print(f"{'benchmark':40s} {'result':>14s} {'baseline':>14s} {'change':>8s}")
+    for name, r in results.items():
+        line = f"{name:40s} {r['value']:10.3f} {r['unit']:>4s}"
+        if name in baseline:
+            b = baseline[name]["value"]
+            # throughput should go up, time should go down
+            change = (r["value"] - b) / b
+            if r["unit"] == "s":
+                change = -change
+            line += f" {b:10.3f} {r['unit']:>4s} {change:+8.1%}"
+            if change < -threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the dllup benchmarks.")
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--save", action="store_true", help="store a new baseline")
+    parser.add_argument("--quick", action="store_true", help="use smaller corpora")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown reported as a regression",
+    )
+    args = parser.parse_args()
+    scale = 0.1 if args.quick else 1.0
+    if args.baseline is None:
+        args.baseline = BENCH / (
+            "baseline-quick.json" if args.quick else "baseline.json"
+        )
+    baseline_path = args.baseline.resolve()
+    baseline = {}
+    if baseline_path.exists():
+        stored = json.loads(baseline_path.read_text())
+        if stored.get("scale") != scale:
+            sys.exit(
+                f"{baseline_path} was measured at scale {stored.get('scale')}, "
+                f"not {scale}; use another --baseline"
+            )
+        baseline = stored["results"]
+
+    results = {}
+    cwd = Path.cwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / "bin").mkdir()
+        install_stubs(tmp / "bin")
+        (tmp / "texcache").mkdir()
+        os.chdir(tmp)
+        try:
+            bench_parsers(results, scale, args.repeat)
+            bench_build(results, scale)
+        finally:
+            os.chdir(cwd)
+
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        stored = {"scale": scale, "results": results}
+        baseline_path.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n")
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
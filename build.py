@@ -23,13 +23,25 @@
 # THE SOFTWARE.
 
 import dllup
+import dllupast
+import dlluptex
+import feeds
+import images
+import parsecache
+import profiling
+import searchindex
+import writer
 from get_image_dimensions import get_image_dimensions
+import argparse
+import cProfile
+import functools
 import hashlib
 import os
 import re
+import string
 import struct
+import subprocess
 import time
-import PIL
 from pathlib import Path
 from operator import itemgetter
 
@@ -53,7 +65,15 @@ def readconfig(configpath: Path):
     # Reads a config file which is a simple text file of key-value pairs.
     # One key-value pair per line, key (no whitespaces) is separated from
     # value by whitespace.
-    # Valid keys are: type, root
+    # Valid keys are: type, root, tex, url, widths, formats, inlinemath
+    # tex lists the documents (without .dllu) that are also rendered to
+    # <name>_dllu.tex for dlluptex.
+    # url, in the top level config, is the site's scheme and host, eg
+    # https://daniel.lawrence.lu, for the sitemap and feeds.
+    # widths and formats, in the top level config, set the copies made of
+    # images (see images.py).
+    # inlinemath, in the top level config, is the size in characters up to
+    # which equation svgs are put inline in pages (see dllup.inline_svg).
     if not configpath.exists():
         return {}
     config = open(configpath).read()
@@ -61,16 +81,67 @@ def readconfig(configpath: Path):
     return {c[0]: c[1] for c in configsplit if len(c) >= 2}
 
 
-def recurse(path: Path = Path(), rootnav="", root=""):
-    global htmlhead
-    global htmlfoot
-    children = list(path.iterdir())
-    folderdata = [get_folderdata(c) for c in children if c.is_dir()]
+def compile_template(template, **static):
+    # Splits a str.format template once into a tuple of (literal, slot) pairs,
+    # where slot is the name of the field following the literal (None for the
+    # final chunk). Keyword arguments are spliced in as static text; a value
+    # that is itself a compiled template has its chunks and slots inlined.
+    chunks = []
+    text = ""
+    for literal, field, _, _ in string.Formatter().parse(template):
+        text += literal
+        if field is None:
+            continue
+        if field not in static:
+            chunks.append((text, field))
+            text = ""
+        elif isinstance(static[field], str):
+            text += static[field]
+        else:
+            for literal, slot in static[field]:
+                text += literal
+                if slot is not None:
+                    chunks.append((text, slot))
+                    text = ""
+    chunks.append((text, None))
+    return tuple(chunks)
+
+
+@functools.lru_cache
+def root_template(template, root):
+    return tuple((dllup.rootify(literal, root), slot) for literal, slot in template)
+
+
+def render(template, root, rooted=(), **fields):
+    # Renders a compiled template into a list of chunks suitable for
+    # writelines, rewriting root-relative URLs in each piece separately so the
+    # whole page never has to be copied. Fields named in rooted already have
+    # their URLs prefixed, like page bodies from the parse cache, and are
+    # passed through untouched.
+    out = []
+    for literal, slot in root_template(template, root):
+        out.append(literal)
+        if slot in rooted:
+            out.append(fields[slot])
+        elif slot is not None:
+            out.append(dllup.rootify(str(fields[slot]), root))
+    return out
+
+
+def recurse(path: Path = Path(), rootnav="", root="", private=False):
+    # private is set for folders with a private file and everything below them,
+    # which are left out of the sitemap, feeds and search index
+    private = private or (path / "private").exists()
+    with profiling.stage("tree walk"):
+        children = list(path.iterdir())
+    with profiling.stage("folderdata"):
+        folderdata = [get_folderdata(c) for c in children if c.is_dir()]
 
     config = readconfig(path / "config")
     if "root" in config:
         root = config["root"]
     navtype = config["type"] if "type" in config else None
+    texdocs = config.get("tex", "").split()
 
     # generate navigation markup
     nav = ""
@@ -92,7 +163,7 @@ def recurse(path: Path = Path(), rootnav="", root=""):
         )
     for f in folderdata:
         try:
-            f["child"] = f'{root}/{f["child"]}'
+            f["child"] = f'/{f["child"]}'
             if navtype == "root":
                 rootnav += ROOT_NAV.format(**f)
             elif navtype == "blogposts":
@@ -101,37 +172,75 @@ def recurse(path: Path = Path(), rootnav="", root=""):
                 nav += PORTFOLIO_NAV.format(**f)
         except KeyError:
             pass  # ignore folders without complete data
-
-    breadcrumbs = generate_breadcrumbs(path, root)
+    if navtype == "blogposts" and not private:
+        with profiling.stage("feeds"):
+            title = get_folderdata(path).get("title", path.name)
+            feeds.write_feeds(path, root, feeds.text(title), folderdata)
+
+    breadcrumbs = generate_breadcrumbs(path)
+    # pages are rebuilt when their source, the page templates or the
+    # navigation around them change
+    navdigest = hashlib.sha1(
+        f"{root}\0{breadcrumbs}\0{rootnav}\0{navtype}\0{nav}".encode("utf-8")
+    ).digest()
     # recurse through children
     for child in children:
         if child.is_dir():
-            recurse(child, rootnav, root)
-        if child.suffix in RASTER_IMG and "_600" not in child.name:
-            resize_images(path, child.name)
+            recurse(child, rootnav, root, private)
+        if child.suffix in RASTER_IMG and not images.is_copy(child):
+            images.submit(child)
 
     for child in children:
         if child.suffix == ".dllu":
+            start = time.perf_counter()
             with open(child) as o:
                 markup = o.read()
             hash = hashlib.sha1(
-                struct.pack("f", child.stat().st_mtime) + b"dllu"
+                struct.pack("f", child.stat().st_mtime)
+                + b"dllu"
+                + pagedigest
+                + navdigest
             ).hexdigest()
             sig = f"<!--{hash}-->"
+            html = path / (child.stem + ".html")
             sig2 = None
             try:
-                with open(path / (child.stem + ".html")) as f:
+                with open(html) as f:
                     f.readline()
-                    sig2 = f.readline()
+                    sig2 = f.readline().rstrip("\n")
             except FileNotFoundError:
                 pass
-            if sig == sig2:
+            url = page_url(path, child.stem, root)
+            if not private:
+                feeds.add_page(url, child.stat().st_mtime)
+            if (
+                sig == sig2
+                and (private or searchindex.indexed(url))
+                and parsecache.up_to_date(markup, path, root)
+            ):
+                # pages built before compression was added have no .gz yet
+                if not writer.compressed(html):
+                    writer.submit(html)
                 continue
 
-            output, metas = dllup.parse(markup)
-            PP = PAGE
+            if child.stem in texdocs:
+                with profiling.stage("parse"):
+                    document = dllupast.parse(markup)
+                with profiling.stage("render"):
+                    output, metas = dllup.render(document, path)
+                output = dllup.rootify(output, root)
+                if parsecache.db is not None:
+                    parsecache.store(markup, path, root, output, metas)
+                with profiling.stage("latex"), open(
+                    path / (child.stem + "_dllu.tex"), "w"
+                ) as f:
+                    f.write(dlluptex.HEADER + dlluptex.render(document, path))
+            else:
+                with profiling.stage("parse"):
+                    output, metas = parsecache.render(markup, path, root)
+            PP = page
             if path == Path():
-                PP = PAGE_HERO
+                PP = page_hero
 
             ss = markup.split("\n===\n", 1)
             if len(ss) > 1:
@@ -143,54 +252,55 @@ def recurse(path: Path = Path(), rootnav="", root=""):
             if "image" in metas:
                 width, height = None, None
                 if metas["image"][:7] != "http://" and metas["image"][:8] != "https://":
+                    images.wait(path / metas["image"])
                     try:
                         width, height = get_image_dimensions(
                             str(path / metas["image"]), "img_size_db.db"
                         )
-                    except PIL.UnidentifiedImageError:
+                    except OSError:
                         pass
                     metas["image"] = f'{root}/{path}/{metas["image"]}'
                 else:
                     try:
                         width, height = get_image_dimensions(metas["image"])
-                    except PIL.UnidentifiedImageError:
+                    except OSError:
                         pass
                 if width is not None and height is not None:
                     metas["image:width"] = width
                     metas["image:height"] = height
 
             meta_html = format_meta(metas)
-            head = htmlhead.format(title=title, metas=meta_html)
 
-            with open(path / (child.stem + ".html"), "w") as f:
-                f.write(
-                    PP.format(
-                        htmlhead=head,
-                        htmlfoot=htmlfoot,
+            with profiling.stage("write"):
+                writer.write(
+                    html,
+                    render(
+                        PP,
+                        root,
+                        rooted=("output",),
+                        title=title,
+                        metas=meta_html,
                         breadcrumbs=breadcrumbs,
                         rootnav=rootnav,
                         navtype=navtype,
                         output=output,
                         time=time.strftime("%Y-%m-%d", time.gmtime()),
-                        child=child,
                         nav=nav,
                         sig=sig,
                         text=child.stem + ".dllu",
-                    )
-                    .replace(
-                        ' src="/',
-                        f' src="{root}/',
-                    )
-                    .replace(
-                        ' href="/',
-                        f' href="{root}/',
-                    )
+                    ),
                 )
+            if searchindex.db is not None and not private:
+                with profiling.stage("search index"):
+                    searchindex.add(url, title, metas)
+            profiling.page(child, time.perf_counter() - start)
 
 
 def format_meta(metas):
     meta_html = "\n".join(
-        f'<meta property="og:{k}" content="{v}" />' for k, v in metas.items()
+        f'<meta property="og:{k}" content="{v}" />'
+        for k, v in metas.items()
+        if k != "toc"
     )
     if "image" in metas:
         meta_html += '<meta name="twitter:card" content="summary_large_image">'
@@ -200,26 +310,19 @@ def format_meta(metas):
     return meta_html
 
 
-def resize_images(path, child):
-    filename = path / child
-    filename600 = path / (filename.stem + "_600" + filename.suffix)
-    filename600x2 = path / (filename.stem + "_600@2x" + filename.suffix)
-    for f in (filename600, filename600x2):
-        scale = 600
-        if "@2x" in f.stem:
-            scale = 1200
-        if not f.exists():
-            os.system(f'gm convert "{filename}" -resize {scale} "{f}"')
+def page_url(path, stem, root):
+    url = root + "/" if path == Path() else f"{root}/{path}/"
+    return url if stem == "index" else f"{url}{stem}.html"
 
 
-def generate_breadcrumbs(path, root):
+def generate_breadcrumbs(path):
     if path == Path():
         return BREAD_HERO
     breadcrumbs = BREAD
     cpath = Path()
     for crumb in path.parts:
         cpath = cpath / crumb
-        breadcrumbs += CRUMB.format(cpath=f"{root}/{cpath}", child=crumb)
+        breadcrumbs += CRUMB.format(cpath=f"/{cpath}", child=crumb)
     return breadcrumbs
 
 
@@ -249,17 +352,105 @@ def get_folderdata(path):
     return folderdata
 
 
+def css_digest(folder="css"):
+    # Hashes the contents of every stylesheet, partials included, so the css
+    # file name changes exactly when its output may.
+    h = hashlib.sha1()
+    for scss in sorted(Path(folder).glob("*.scss")):
+        h.update(scss.name.encode("utf-8") + b"\0")
+        h.update(scss.read_bytes())
+    return h.hexdigest()
+
+
+def start_sass(cssname):
+    # Starts sass in the background unless cssname was already built. sass
+    # writes to a temporary file that only replaces cssname once it succeeds,
+    # so a stylesheet by that name is always a finished one.
+    if os.path.exists(cssname):
+        if not writer.compressed(Path(cssname)):
+            writer.submit(cssname)
+        return None
+    return subprocess.Popen(
+        [
+            "sass",
+            "-s",
+            "compressed",
+            "--no-source-map",
+            "css/dllu.scss",
+            f".{cssname}.tmp",
+        ]
+    )
+
+
+def finish_sass(sass, cssname):
+    if sass is None:
+        return
+    with profiling.stage("sass"):
+        sass.wait()
+    if sass.returncode != 0:
+        print(f"sass failed with exit code {sass.returncode}")
+        if os.path.exists(f".{cssname}.tmp"):
+            os.remove(f".{cssname}.tmp")
+    else:
+        os.replace(f".{cssname}.tmp", cssname)
+        writer.submit(cssname)
+
+
 def main():
-    global htmlhead, htmlfoot
+    global page, page_hero, pagedigest
+    parser = argparse.ArgumentParser(description="Builds the website.")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write build_profile.json and a cProfile dump to build_profile.prof",
+    )
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="write a client-side search index to search/",
+    )
+    args = parser.parse_args()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
     with open("html/head.html") as f:
         htmlhead = f.read()
     with open("html/foot.html") as f:
         htmlfoot = f.read()
-    hash = hashlib.sha1(struct.pack("f", os.path.getmtime("css"))).hexdigest()
-    cssname = f"dllu-{hash}.css"
-    os.system(f"sass -s compressed css/dllu.scss {cssname}")
-    htmlhead = htmlhead.replace("dllu.css", cssname)
+    config = readconfig(Path("config"))
+    images.configure(config.get("widths"), config.get("formats"))
+    dllup.inline_svg = int(config.get("inlinemath", 0))
+    cssname = f"dllu-{css_digest()}.css"
+    writer.start()
+    images.start()
+    sass = start_sass(cssname)
+    htmlhead = compile_template(htmlhead.replace("dllu.css", cssname))
+    page = compile_template(PAGE, htmlhead=htmlhead, htmlfoot=htmlfoot)
+    page_hero = compile_template(PAGE_HERO, htmlhead=htmlhead, htmlfoot=htmlfoot)
+    # options that change the rendered pages
+    options = (images.widths, images.formats, dllup.inline_svg)
+    pagedigest = hashlib.sha1(repr((page, page_hero, options)).encode("utf-8")).digest()
+    feeds.start(config.get("url"))
+    parsecache.open_cache()
+    if args.search:
+        searchindex.open_index()
     recurse()
+    parsecache.close_cache()
+    if args.search:
+        with profiling.stage("search index"):
+            searchindex.close_index()
+    with profiling.stage("feeds"):
+        feeds.write_sitemap()
+    with profiling.stage("image resize wait"):
+        images.finish()
+    finish_sass(sass, cssname)
+    with profiling.stage("compress wait"):
+        writer.finish()
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats("build_profile.prof")
+        profiling.write_report("build_profile.json")
+    profiling.print_summary()
 
 
 if __name__ == "__main__":
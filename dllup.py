@@ -22,6 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import csv
 import html
 import re
 import hashlib
@@ -30,159 +31,181 @@ import sys
 import subprocess
 from bs4 import BeautifulSoup
 
+import dllupast
+import images
+import profiling
+from get_image_dimensions import get_image_dimensions
+
 import pygments
 import pygments.lexers
 import pygments.formatters
 
+# equations whose svg is at most this many characters are put inline in the
+# page rather than linked as images, sharing their glyphs through one hidden
+# svg per page; 0 links every equation
+inline_svg = 0
 
-def splitparse(s, delim, yes, no):
-    return "".join(
-        [
-            yes(ss) if i % 2 == 1 else no(ss)
-            for (i, ss) in enumerate(re.split("(?<!\\\\)" + delim, s))
-        ]
-    )
+# glyphs of inline equations while a page is rendered, mapping <path> markup
+# without its id to the id it has in the page; None outside of render, where
+# there is no page to hold them, eg for folder titles
+glyphs = None
+
+# files read while rendering, for callers that cache the output; render resets
+# it, but parsetext may also be called on its own, eg for folder titles
+dependencies = []
 
 
 def unescape(s):
     return re.sub("(?<!\\\\)\\\\", "", s)
 
 
-def parse(s):
-    s = s.replace("\r", "")
+def rootify(s, root):
+    # Prefixes root-relative src and href attributes with the site root.
+    if not root:
+        return s
+    return s.replace(' src="/', f' src="{root}/').replace(' href="/', f' href="{root}/')
+
+
+def parse(s, path=""):
+    # path is the directory of the document, used to resolve external files.
+    return render(dllupast.parse(s), path)
+
+
+def render(document, path=""):
+    # Renders a syntax tree from dllupast.parse into HTML, returning the HTML
+    # and a dict of metadata about the page.
+    global basepath
     global hnum
     global fignum
     global tablenum
     global eqnum
     global toc
     global metas
+    global dependencies
+    global glyphs
     hnum = [0] * 6
     fignum = 0
     tablenum = 0
     eqnum = 0
-    toc = ""
+    toc = []
     metas = {}
-    ss = s.split("\n===\n", 1)
-    if len(ss) > 1:
-        header = parseheader(ss[0])
-        body = parseraw(ss[1])
-        toc += "".join(["</ol>" for hh in hnum if hh > 0])
-        return f'<header>{header}<div class="toc">{toc}</div></header>{body}', metas
-    body = parseraw(s)
-    if toc != "":
-        return f'<header><div class="toc">{toc}</div></header>{body}'
+    dependencies = []
+    glyphs = {}
+    basepath = path
+    _, header, blocks = document
+    if header is not None:
+        header = renderheader(header)
+    body = "".join([renderblock(block) for block in blocks])
+    if glyphs:
+        body += rendersprite()
+    glyphs = None
+    if toc:
+        metas["toc"] = toc
+    if header is not None:
+        return (
+            f'<header>{header}<div class="toc">{rendertoc(toc)}</div></header>{body}',
+            metas,
+        )
+    if toc:
+        return f'<header><div class="toc">{rendertoc(toc)}</div></header>{body}', metas
     return body, metas
 
 
-def parseheader(s):
-    s = s.strip().split("\n\n")
-    return '<h1 id="top">{}</h1>{}'.format(
-        parsetext(s[0]),
-        "".join(["<p>%s</p>" % parsetext(ss) for ss in s[1:]]),
-    )
-
-
-def parseraw(s):
-    return splitparse(s, "\n\\?\\?\\?\n", lambda x: "%s" % x, parsecode)
-
-
-def parsecode(s):
-    return splitparse(s, "\n~~~\n", highlight, parsecode2)
+def rendertoc(toc):
+    # Renders the table of contents as nested ordered lists, opening a list
+    # whenever a header is deeper than the previous one and closing lists until
+    # the enclosing level is reached when it is shallower.
+    out = []
+    levels = []
+    for entry in toc:
+        while levels and levels[-1] > entry["level"]:
+            out.append("</li></ol>")
+            levels.pop()
+        if levels and levels[-1] == entry["level"]:
+            out.append("</li>")
+        else:
+            out.append("<ol>")
+            levels.append(entry["level"])
+        out.append(
+            '<li><a href="#s{number}"><span class="tocnum">{number}</span> '
+            "<span>{title}</span></a>".format(**entry)
+        )
+    out.append("</li></ol>" * len(levels))
+    return "".join(out)
 
 
-def parsecode2(s):
-    return splitparse(
-        s, "\n~~~~\n", lambda x: "<pre>%s</pre>" % html.escape(x), parsenormal
+def renderheader(paragraphs):
+    return '<h1 id="top">{}</h1>{}'.format(
+        renderinlines(paragraphs[0]),
+        "".join(["<p>%s</p>" % renderinlines(p) for p in paragraphs[1:]]),
     )
 
 
-def parsenormal(s):
-    return "".join(parseblock(ss) for ss in s.strip().split("\n\n"))
-
-
-def parseblock(s):
-    global hnum
+def renderblock(block):
     global eqnum
-    global toc
-    if len(s.split()) == 0:
-        return ""
-    for h in range(6, 0, -1):
-        # header
-        if s[:h] == "#" * h:
-            if hnum[h - 1] == 0:
-                toc += "<ol>"
-            hnum[h - 1] += 1
-            for j in range(h, 6):
-                if hnum[j] > 0:
-                    toc += "</ol></li>"
-                    hnum[j] = 0
-            if hnum[h] > 0:
-                toc += "</li>"
-            hh = ".".join([str(jj) for jj in hnum[:h]])
-            hhh = parsetext(s[h:])
-            toc += (
-                '<li><a href="#s%s"><span class="tocnum">%s</span> <span>%s</span></a>'
-                % (hh, hh, hhh)
-            )
-            return (
-                '<h%d id="s%s"><a href="#s%s" class="hnum">%s</a> <span>%s</span></h%d>'
-                % (h, hh, hh, hh, hhh, h)
-            )
-    if s[:2] == "> ":
-        # blockquote
-        return "<blockquote>%s</blockquote>" % parsetext(s[2:])
-    if s[:4] == "pic ":
-        # images
-        return '<div class="pics">%s</div>' % parsepics(s)
-    if s[:2] == "$ ":
-        # equation
+    kind = block[0]
+    if kind == "raw":
+        return block[1]
+    if kind == "highlight":
+        return highlight(block[2], block[1])
+    if kind == "pre":
+        return "<pre>%s</pre>" % html.escape(block[1])
+    if kind == "header":
+        h = block[1]
+        hnum[h - 1] += 1
+        hnum[h:] = [0] * (6 - h)
+        hh = ".".join([str(jj) for jj in hnum[:h]])
+        hhh = renderinlines(block[2])
+        toc.append({"level": h, "number": hh, "title": hhh})
+        return (
+            '<h%d id="s%s"><a href="#s%s" class="hnum">%s</a> <span>%s</span></h%d>'
+            % (h, hh, hh, hh, hhh, h)
+        )
+    if kind == "quote":
+        return "<blockquote>%s</blockquote>" % renderinlines(block[1])
+    if kind == "pics":
+        return '<div class="pics">%s</div>' % renderpics(block[1])
+    if kind == "equation":
         eqnum += 1
         return (
             '<div class="math" id="eq%d"><a href="#eq%d" class="eqnum">%d</a> %s</div>'
-            % (eqnum, eqnum, eqnum, parsemath("%s" % s[2:]))
+            % (eqnum, eqnum, eqnum, parsemath(block[1]))
+        )
+    if kind == "list":
+        return renderul(block)
+    if kind == "olist":
+        return "<ol>%s</ol>" % "".join(
+            ["<li>%s</li>" % renderinlines(item) for item in block[1]]
         )
-    if s[:2] == "* ":
-        # list
-        return parseul(s, 1)
-    if s[:3] == "1. ":
-        # numbered list
-        return "<ol>%s</ol>" % parseol(s)
-    if s[:2] == "| ":
-        # table
-        return parsetable(s)
-    if s[:3] == ":: ":
-        # big button
-        s = s[3:].rsplit(" ", 1)
-        return '<p><a href="{}" class="bigbutton">{}</a></p>'.format(s[1], s[0])
-
-    output = parsetext(s)
+    if kind == "table":
+        return rendertable(block)
+    if kind == "csv":
+        return rendercsv(block)
+    if kind == "button":
+        return '<p><a href="{}" class="bigbutton">{}</a></p>'.format(block[2], block[1])
+
+    output = renderinlines(block[1])
     if "description" not in metas:
         metas["description"] = BeautifulSoup(output, "html.parser").get_text()
     return f"<p>{output}</p>"
 
 
-def parsepics(s):
+def renderpics(pics):
     global fignum
-    global metas
-    lines = [ss[4:].split(None, 1) for ss in s.split("\n")]
     out = ""
-    for ss in lines:
+    for src, alt, caption, fullsize in pics:
         fignum += 1
-        ss[1] = ss[1].split(": ", 1)
         # use an image that is resized to 600px instead if the image is locally referenced
-        pic = ss[0]
-        ss[1][1] = ss[1][1].split(" (full size: ")
-        fullpic = ss[0]
-        if (
-            len(ss[1][1]) == 1
-            and ss[0][:4] != "http"
-            and ss[0][-4:] in [".png", ".jpg"]
-        ):
-            pic = ss[0][:-4] + "_600" + ss[0][-4:]
-        elif len(ss[1][1]) == 2:
+        pic = src
+        fullpic = src
+        img = f'<img src="{pic}" alt="{alt}"/>'
+        if fullsize is None and src[:4] != "http" and src[-4:] in [".png", ".jpg"]:
+            pic = src[:-4] + "_600" + src[-4:]
+            img = renderpicture(src, pic, alt)
+        elif fullsize is not None:
             # if the description contains the string " (full size: %s)" then use that
-            fullpic = ss[1][1][1][:-1]
-        out += f'<figure id="fig{fignum}"><a href="{fullpic}"><img src="{pic}" alt="{ss[1][0]}"/></a><figcaption><a href="#fig{fignum}" class="fignum">FIGURE {fignum}</a> {parsetext(ss[1][1][0])}</figcaption></figure>'
+            fullpic = fullsize
+        out += f'<figure id="fig{fignum}"><a href="{fullpic}">{img}</a><figcaption><a href="#fig{fignum}" class="fignum">FIGURE {fignum}</a> {renderinlines(caption)}</figcaption></figure>'
 
         if "image" not in metas:
             metas["image"] = pic
@@ -190,107 +213,120 @@ def parsepics(s):
     return out
 
 
-def parseul(s, level):
-    s = "\n" + s
-    items = [ss.strip() for ss in ("\n" + s).split("\n" + "*" * level + " ")]
-    out = parsetext(items[0])
-    if len(items) > 1:
-        out += "<ul>%s</ul>" % "".join(
-            ["<li>%s</li>" % parseul(item, level + 1) for item in items[1:]]
-        )
+def renderpicture(src, pic, alt):
+    # Offers the copies made by images.py in every width and format, and gives
+    # the size of the image so that browsers can lay out the page before it
+    # loads. pic is the fallback, which is shown at most 600px wide.
+    filename = os.path.join(basepath, src)
+    dependencies.append(filename)
+    try:
+        width, height = get_image_dimensions(filename, "img_size_db.db")
+    except OSError:
+        return f'<img src="{pic}" alt="{alt}"/>'
+    widths = images.srcset_widths(width)
+    shown = min(width, 600)
+    sizes = f'sizes="(max-width: {shown}px) 100vw, {shown}px"'
+    out = ["<picture>"]
+    for ext in images.formats:
+        srcset = ", ".join(f"{images.name(src, w, ext)} {w}w" for w in widths)
+        out.append(f'<source type="{images.TYPES[ext][1]}" srcset="{srcset}" {sizes}/>')
+    srcset = ", ".join(
+        f"{src if w == width else images.name(src, w, src[-4:])} {w}w" for w in widths
+    )
+    out.append(
+        f'<img src="{pic}" srcset="{srcset}" {sizes} width="{shown}" '
+        f'height="{round(height * shown / width)}" alt="{alt}"/></picture>'
+    )
+    return "".join(out)
+
+
+def renderul(block):
+    _, text, items = block
+    out = renderinlines(text)
+    if items:
+        out += "<ul>%s</ul>" % "".join(["<li>%s</li>" % renderul(i) for i in items])
     return out
 
 
-def parseol(s):
-    return "".join(
-        ["<li>%s</li>" % parsetext(ss) for ss in re.split("\n\\d+\\. ", s[2:])]
-    )
+def rendertable(block):
+    global tablenum
+    tablenum += 1
+    _, header, rows, caption = block
+    out = [f'<figure id="table{tablenum}"><table>', renderrow(header, "th")]
+    out.extend(renderrow(dllupast.parserow(row), "td") for row in rows)
+    out.append(tablecaption(caption))
+    return "".join(out)
 
 
-def parsetable(s):
+def rendercsv(block):
+    # The first row of the file is the header. Rows are read and rendered one
+    # at a time so that large files are never held in memory twice.
     global tablenum
     tablenum += 1
-    rows = s.split("\n")
-    table = (
-        tablenum,
-        parseth(rows[0]),
-        "".join([parserow(row) for row in rows[1:-1]]),
-        tablenum,
-        tablenum,
-        parsetext(rows[-1]),
-    )
-    return (
-        '<figure id="table%d"><table>%s%s</table><figcaption><a href="#table%d" class="fignum">Table %d</a> %s</figcaption></figure>'
-        % table
-    )
+    _, filename, caption = block
+    out = [f'<figure id="table{tablenum}"><table>']
+    dependencies.append(os.path.join(basepath, filename))
+    try:
+        with open(os.path.join(basepath, filename), newline="") as f:
+            reader = csv.reader(f)
+            out.append(
+                renderrow([dllupast.parsecell(th) for th in next(reader, [])], "th")
+            )
+            for row in reader:
+                out.append(renderrow([dllupast.parsecell(td) for td in row], "td"))
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        # like a failed equation, leave the table empty rather than stop
+        sys.stderr.write(f"Table error: {filename}\n{e}\n")
+        del out[1:]
+    out.append(tablecaption(caption))
+    return "".join(out)
 
 
-def parseth(s):
-    return "<tr>%s</tr>" % "".join(
-        ["<th>%s</th>" % parsetext(th) for th in s.split("|") if th.strip() != ""]
+def tablecaption(caption):
+    return (
+        f'</table><figcaption><a href="#table{tablenum}" class="fignum">'
+        f"Table {tablenum}</a> {renderinlines(caption)}</figcaption></figure>"
     )
 
 
-def parserow(s):
-    if re.match("^(\\||\\s|\\-)*$", s) is not None:
-        return ""
+def renderrow(cells, tag):
     return "<tr>%s</tr>" % "".join(
-        ["<td>%s</td>" % parsetext(td) for td in s.split("|") if td.strip() != ""]
+        [
+            "<%s>%s</%s>"
+            % (tag, "<br/>".join([renderinlines(line) for line in cell]), tag)
+            for cell in cells
+        ]
     )
 
 
 def parsetext(s):
-    return splitparse(
-        s.strip(), "`", lambda x: "<code>%s</code>" % html.escape(x), parsetext2
-    )
-
-
-def parsetext2(s):
-    return splitparse(s, "\\$", lambda x: "%s" % parsemath(x, True), parselink)
-
-
-def parselink(s):
-    return parseref(
-        re.sub(
-            "\\[([^\\]]+)\\]\\(([^)]+)\\)",
-            '\n~~~\n<a href="\\2">\n~~~\n\\1\n~~~\n</a>\n~~~\n',
-            s,
-        )
-    )
-
-
-def parseref(s):
-    return parsecite(
-        re.sub(
-            "\\[\\#([^\\]]+)\\]",
-            '\n~~~\n<span class="refname" id="\\1">\\1</span>\n~~~\n',
-            s,
-        )
-    )
-
-
-def parsecite(s):
-    return parsespan(
-        re.sub(
-            "\\(\\#([^\\)]+)\\)",
-            '\n~~~\n<a class="refname" href="#\\1">\\1</a>\n~~~\n',
-            s,
-        )
-    )
-
-
-def parsespan(s):
-    return splitparse(s, "\n~~~\n", lambda x: x, parseem)
-
-
-def parseem(s):
-    return splitparse(s, "_", lambda x: "<em>%s</em>" % typographer(x), parsestrong)
-
-
-def parsestrong(s):
-    return splitparse(
-        s, "\\*\\*", lambda x: "<strong>%s</strong>" % typographer(x), typographer
-    )
+    return renderinlines(dllupast.parsetext(s))
+
+
+def renderinlines(nodes):
+    return "".join([renderinline(node) for node in nodes])
+
+
+def renderinline(node):
+    kind = node[0]
+    if kind == "text":
+        return typographer(node[1])
+    if kind == "plain":
+        return html.escape(node[1])
+    if kind == "em":
+        return "<em>%s</em>" % typographer(node[1])
+    if kind == "strong":
+        return "<strong>%s</strong>" % typographer(node[1])
+    if kind == "code":
+        return "<code>%s</code>" % html.escape(node[1])
+    if kind == "math":
+        return parsemath(node[1], True)
+    if kind == "link":
+        return '<a href="%s">%s</a>' % (node[1], renderinlines(node[2]))
+    if kind == "ref":
+        return '<span class="refname" id="%s">%s</span>' % (node[1], node[1])
+    if kind == "cite":
+        return '<a class="refname" href="#%s">%s</a>' % (node[1], node[1])
 
 
 def typographer(s):
@@ -324,20 +360,25 @@ def parsemath(s, inline=False):
     filepath = os.path.join("texcache", filename)
 
     s = re.sub(greekbm, r"\\boldsymbol{\\\1}", s)
+    dependencies.append(filepath)
     try:
         if not os.path.isfile(filepath) or os.path.getsize(filepath) == 0:
+            profiling.count("math cache miss")
             # extra space so that it won't be treated as an option if starting with '-'
             mathjaxargs = ["tex2svg", " " + s]
             if inline:
                 mathjaxargs.append("--inline")
-            p = subprocess.Popen(mathjaxargs, stdout=subprocess.PIPE)
-            jax, errors = p.communicate()
+            with profiling.stage("math render"):
+                p = subprocess.Popen(mathjaxargs, stdout=subprocess.PIPE)
+                jax, errors = p.communicate()
             if errors:
                 sys.stderr.write("Equation error: {}\n", errors)
             else:
                 f = open(filepath, "w")
                 f.write(jax.decode("utf-8"))
                 f.close()
+        else:
+            profiling.count("math cache hit")
         jax = open(filepath).read()
         style = re.search('style=".*?"', jax)
 
@@ -349,6 +390,8 @@ def parsemath(s, inline=False):
         width = jax[width.start() : width.end()]
         width = width.replace("=", ":").replace('"', "")
 
+        if glyphs is not None and len(jax) <= inline_svg:
+            return inlinesvg(jax, html.escape(s))
         style = f'{jax[style.start() : style.end() - 1]} {height}; {width};"'
         return f'<img src="/texcache/{filename}" alt="{html.escape(s)}" {style}/>'
     except Exception as e:
@@ -356,11 +399,54 @@ def parsemath(s, inline=False):
         return ""
 
 
-def highlight(s):
-    firstline = s.split("\n", 1)[0]
-    if firstline[:5] == "lang ":
-        lexer = pygments.lexers.get_lexer_by_name(firstline[5:], stripall=True)
-        s = s.split("\n", 1)[1]
+svgdefs = re.compile("<defs[^>]*>(.*?)</defs>", re.S)
+svgpath = re.compile("<path\\b[^>]*>(?:</path>)?")
+svgid = re.compile(' id="([^"]*)"')
+# mathjax titles its svgs with ids that would clash within a page
+svgtitle = re.compile('<title[^>]*>.*?</title>| aria-labelledby="[^"]*"', re.S)
+svghref = re.compile('href="#([^"]*)"')
+
+
+def inlinesvg(jax, alt):
+    # Moves the glyphs of an equation into the page's sprite, where equal
+    # glyphs from different equations are stored once, and points the <use>
+    # elements at them. mathjax numbers glyph ids per run, so the same id in
+    # two files is not necessarily the same glyph, hence keying on the markup.
+    ids = {}
+
+    def move(m):
+        def glyph(p):
+            id = svgid.search(p.group())
+            if id is None:
+                return p.group()
+            key = svgid.sub("", p.group(), 1)
+            if key not in glyphs:
+                glyphs[key] = f"mj{len(glyphs)}"
+            ids[id.group(1)] = glyphs[key]
+            return ""
+
+        rest = svgpath.sub(glyph, m.group(1))
+        return f"<defs>{rest}</defs>" if rest.strip() else ""
+
+    jax = svgtitle.sub("", svgdefs.sub(move, jax))
+    jax = svghref.sub(lambda m: f'href="#{ids.get(m.group(1), m.group(1))}"', jax)
+    return jax.strip().replace("<svg ", f'<svg aria-label="{alt}" ', 1)
+
+
+def rendersprite():
+    paths = "".join(
+        key.replace("<path", f'<path id="{id}"', 1) for key, id in glyphs.items()
+    )
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" aria-hidden="true" '
+        f'style="position: absolute; width: 0; height: 0"><defs>{paths}</defs></svg>'
+    )
+
+
+@profiling.timed("highlight")
+def highlight(s, lang=None):
+    if lang is not None:
+        lexer = pygments.lexers.get_lexer_by_name(lang, stripall=True)
     else:
         lexer = None
         try:
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# The templating engine and the parser for the dllup markup language are hereby
+# released open-source under the MIT License.
+#
+# Copyright (c) 2015 Daniel Lawrence Lu
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Parses dllup markup into a syntax tree shared by the HTML (dllup.py) and
+# LaTeX (dlluptex.py) renderers.
+#
+# Nodes are plain tuples whose first element names the node, so that a tree
+# can be stored with marshal or pickle. A document is
+#
+#     ("document", header, blocks)
+#
+# where header is None or a list of paragraphs (lists of inline nodes) and
+# blocks is a list of
+#
+#     ("raw", text)                  ??? passed through verbatim
+#     ("highlight", lang, code)      ~~~ lang is None unless given
+#     ("pre", text)                  ~~~~
+#     ("header", level, inlines)     level is 1 to 6
+#     ("quote", inlines)
+#     ("pics", [(src, alt, caption inlines, full size src or None), ...])
+#     ("equation", tex)
+#     ("list", inlines, [sublists])  bullet list; a sublist is also a "list"
+#     ("olist", [inlines, ...])
+#     ("table", header cells, rows, caption inlines)
+#     ("csv", filename, caption inlines)
+#     ("button", text, href)
+#     ("paragraph", inlines)
+#
+# A table cell is a list of lines, each a list of inline nodes; lines are
+# separated by a literal \n outside of code and math in the markup. The rows
+# of a table are kept as markup, to be split into cells with parserow as they
+# are rendered, so that a large table costs about as much as its text. Inline
+# nodes are
+#
+#     ("text", s)            text to be run through the typographer
+#     ("plain", s)           text without any markup, only needs escaping
+#     ("em", s) ("strong", s) ("code", s) ("math", tex)
+#     ("link", href, inlines) ("ref", name) ("cite", name)
+
+import re
+
+# bump whenever the shape of the tree or the output of a renderer changes
+VERSION = 4
+
+
+def split(s, delim):
+    return re.split("(?<!\\\\)" + delim, s)
+
+
+def parse(s):
+    s = s.replace("\r", "")
+    ss = s.split("\n===\n", 1)
+    if len(ss) > 1:
+        return ("document", parseheader(ss[0]), parseraw(ss[1]))
+    return ("document", None, parseraw(s))
+
+
+def parseheader(s):
+    return [parsetext(ss) for ss in s.strip().split("\n\n")]
+
+
+def parseraw(s):
+    blocks = []
+    for i, ss in enumerate(split(s, "\n\\?\\?\\?\n")):
+        if i % 2 == 1:
+            blocks.append(("raw", ss))
+        else:
+            parsecode(ss, blocks)
+    return blocks
+
+
+def parsecode(s, blocks):
+    for i, ss in enumerate(split(s, "\n~~~\n")):
+        if i % 2 == 1:
+            blocks.append(parsehighlight(ss))
+        else:
+            parsecode2(ss, blocks)
+
+
+def parsecode2(s, blocks):
+    for i, ss in enumerate(split(s, "\n~~~~\n")):
+        if i % 2 == 1:
+            blocks.append(("pre", ss))
+        else:
+            parsenormal(ss, blocks)
+
+
+def parsehighlight(s):
+    firstline = s.split("\n", 1)[0]
+    if firstline[:5] == "lang ":
+        return ("highlight", firstline[5:], s.split("\n", 1)[1])
+    return ("highlight", None, s)
+
+
+def parsenormal(s, blocks):
+    for ss in s.strip().split("\n\n"):
+        if len(ss.split()) > 0:
+            blocks.append(parseblock(ss))
+
+
+# csv path/to/file.csv: caption, on a line of its own; anything else starting
+# with "csv " is an ordinary paragraph
+csvblock = re.compile("csv ([^\n:]*\\.csv)(?:: ([^\n]*))?")
+
+
+def parseblock(s):
+    h = min(len(s) - len(s.lstrip("#")), 6)
+    if h > 0:
+        # header
+        return ("header", h, parsetext(s[h:]))
+    if s[:2] == "> ":
+        # blockquote
+        return ("quote", parsetext(s[2:]))
+    if s[:4] == "pic ":
+        # images
+        return ("pics", parsepics(s))
+    if s[:2] == "$ ":
+        # equation
+        return ("equation", s[2:])
+    if s[:2] == "* ":
+        # list
+        return parseul(s, 1)
+    if s[:3] == "1. ":
+        # numbered list
+        return ("olist", [parsetext(ss) for ss in re.split("\n\\d+\\. ", s[2:])])
+    if s[:2] == "| ":
+        # table
+        return parsetable(s)
+    m = csvblock.fullmatch(s)
+    if m is not None:
+        # table loaded from an external csv file
+        return ("csv", m.group(1), parsetext(m.group(2) or ""))
+    if s[:3] == ":: ":
+        # big button
+        s = s[3:].rsplit(" ", 1)
+        return ("button", s[0], s[1])
+    return ("paragraph", parsetext(s))
+
+
+def parsepics(s):
+    # pic src alt text: caption (full size: fullsrc)
+    pics = []
+    for line in s.split("\n"):
+        src, _, rest = line[4:].partition(" ")
+        alt, _, caption = rest.strip().partition(": ")
+        caption = caption.split(" (full size: ")
+        fullsize = caption[1][:-1] if len(caption) == 2 else None
+        pics.append((src, alt, parsetext(caption[0]), fullsize))
+    return pics
+
+
+def parseul(s, level):
+    s = "\n" + s
+    items = [ss.strip() for ss in ("\n" + s).split("\n" + "*" * level + " ")]
+    return ("list", parsetext(items[0]), [parseul(ss, level + 1) for ss in items[1:]])
+
+
+separatorrow = re.compile("(\\||\\s|\\-)*")
+
+
+def parsetable(s):
+    rows = s.split("\n")
+    return (
+        "table",
+        parserow(rows[0]),
+        [row for row in rows[1:-1] if separatorrow.fullmatch(row) is None],
+        parsetext(rows[-1]),
+    )
+
+
+def parserow(s):
+    return [parsecell(td) for td in s.split("|") if td.strip() != ""]
+
+
+# characters and sequences that parsetext may transform, other than those
+# that only need escaping
+markupchars = re.compile("[`$\\[_*\"'\\\\]|\\(#|--|\\.\\.\\.")
+
+
+def parsecell(s):
+    # Table cells are usually plain numbers or words, so skip the inline
+    # parser when there is nothing for it to do.
+    s = s.strip()
+    if markupchars.search(s) is None:
+        return [[("plain", s)]]
+    return [parsetext(ss) for ss in splitcell(s)]
+
+
+cellbreak = re.compile("`[^`]*`|\\$[^$]*\\$|\\\\n")
+
+
+def splitcell(s):
+    lines = []
+    start = 0
+    for m in cellbreak.finditer(s):
+        if m.group() == "\\n":
+            lines.append(s[start : m.start()])
+            start = m.end()
+    lines.append(s[start:])
+    return lines
+
+
+def parsetext(s):
+    nodes = []
+    for i, ss in enumerate(split(s.strip(), "`")):
+        if i % 2 == 1:
+            nodes.append(("code", ss))
+        else:
+            parsetext2(ss, nodes)
+    return nodes
+
+
+def parsetext2(s, nodes):
+    for i, ss in enumerate(split(s, "\\$")):
+        if i % 2 == 1:
+            nodes.append(("math", ss))
+        else:
+            parselink(ss, nodes)
+
+
+def parselink(s, nodes):
+    # Links, references and citations are first replaced by markers between
+    # \n~~~\n delimiters, which cannot otherwise occur in inline text, and then
+    # split out so that emphasis never spans across them.
+    s = re.sub(
+        "\\[([^\\]]+)\\]\\(([^)]+)\\)",
+        "\n~~~\n\0link \\2\n~~~\n\\1\n~~~\n\0/link\n~~~\n",
+        s,
+    )
+    s = re.sub("\\[\\#([^\\]]+)\\]", "\n~~~\n\0ref \\1\n~~~\n", s)
+    s = re.sub("\\(\\#([^\\)]+)\\)", "\n~~~\n\0cite \\1\n~~~\n", s)
+    stack = []
+    for i, ss in enumerate(split(s, "\n~~~\n")):
+        if i % 2 == 0:
+            parseem(ss, nodes)
+        elif ss[:6] == "\0link ":
+            stack.append((nodes, ss[6:]))
+            nodes = []
+        elif ss == "\0/link":
+            parent, href = stack.pop()
+            parent.append(("link", href, nodes))
+            nodes = parent
+        elif ss[:5] == "\0ref ":
+            nodes.append(("ref", ss[5:]))
+        elif ss[:6] == "\0cite ":
+            nodes.append(("cite", ss[6:]))
+
+
+def parseem(s, nodes):
+    for i, ss in enumerate(split(s, "_")):
+        if i % 2 == 1:
+            nodes.append(("em", ss))
+        else:
+            for j, sss in enumerate(split(ss, "\\*\\*")):
+                if j % 2 == 1:
+                    nodes.append(("strong", sss))
+                elif sss != "":
+                    nodes.append(("text", sss))
@@ -22,17 +22,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import concurrent.futures
+import csv
+import hashlib
 import re
 import os
+import sys
+import urllib.parse
 
+import requests
 
-def splitparse(s, delim, yes, no):
-    return "".join(
-        [
-            yes(ss) if i % 2 == 1 else no(ss)
-            for (i, ss) in enumerate(re.split("(?<!\\\\)" + delim, s))
-        ]
-    )
+import dllupast
+
+HEADER = (
+    "% LaTeX document generated using dllup.\n"
+    "% https://daniel.lawrence.lu/programming/dllup/\n"
+)
+# remote figures are downloaded here, relative to the document
+FIGCACHE = "figcache"
 
 
 def escape(s):
@@ -42,115 +49,92 @@ def escape(s):
     return s
 
 
-def parse(s):
-    s = s.replace("\r", "")
+def parse(s, path=""):
+    # path is the directory of the document, used to resolve external files.
+    return render(dllupast.parse(s), path)
+
+
+def render(document, path=""):
+    # Renders a syntax tree from dllupast.parse into LaTeX.
+    global basepath
+    global fetched
     global hnum
     global fignum
     global tablenum
     global eqnum
-    global toc
     hnum = [0] * 6
     fignum = 0
     tablenum = 0
     eqnum = 0
-    ss = s.split("\n===\n", 1)
-    if len(ss) > 1:
-        header = parseheader(ss[0])
-        body = parseraw(ss[1])
-        return "\\title{{{}}}\n\\maketitle\n{}".format(header, body)
-    body = parseraw(s)
+    basepath = path
+    fetched = fetchpics(document, path)
+    _, header, blocks = document
+    body = "".join([renderblock(block) for block in blocks])
+    if header is not None:
+        return "\\title{{{}}}\n\\maketitle\n{}".format(renderheader(header), body)
     return body
 
 
-def parseheader(s):
-    return s.strip().replace("\n\n", "\n").replace("\n", "\\\\")
-
-
-def parseraw(s):
-    return splitparse(s, "\n\\?\\?\\?\n", lambda x: "%s" % x, parsecode)
-
-
-def parsecode(s):
-    return splitparse(s, "\n~~~\n", highlight, parsecode2)
-
-
-def parsecode2(s):
-    return splitparse(
-        s,
-        "\n~~~~\n",
-        lambda x: "\\begin{lstlisting}\n%s\n\\end{lstlisting}\n" % x,
-        parsenormal,
-    )
-
-
-def parsenormal(s):
-    return "".join(parseblock(ss) for ss in s.strip().split("\n\n"))
+def renderheader(paragraphs):
+    return "\\\\".join([renderinlines(p).replace("\n", "\\\\") for p in paragraphs])
 
 
-def parseblock(s):
-    global hnum
+def renderblock(block):
     global eqnum
-    global toc
-    if len(s.split()) == 0:
-        return ""
-    for h in range(3, 0, -1):
-        # header
-        if s[:h] == "#" * h:
-            hnum[h - 1] += 1
-            for j in range(h, 6):
-                if hnum[j] > 0:
-                    hnum[j] = 0
-            hh = ".".join([str(jj) for jj in hnum[:h]])
-            hhh = parsetext(s[h:])
-            return "\\{}section{{{}}}\n\\label{{s{}}}\n".format(
-                "sub" * (h - 1), hhh, hh
-            )
-    if s[:2] == "> ":
-        # blockquote
-        return "\\begin{quote}\n%s\\end{quote}\n" % parsetext(s[2:])
-    if s[:4] == "pic ":
-        # images
-        return parsepics(s)
-    if s[:2] == "$ ":
-        # equation
+    kind = block[0]
+    if kind == "raw":
+        return block[1]
+    if kind == "highlight":
+        return highlight(block[2], block[1])
+    if kind == "pre":
+        return "\\begin{lstlisting}\n%s\n\\end{lstlisting}\n" % block[1]
+    if kind == "header":
+        # only three levels of sections; deeper headers keep their extra #s
+        h = min(block[1], 3)
+        hnum[h - 1] += 1
+        hnum[h:] = [0] * (6 - h)
+        hh = ".".join([str(jj) for jj in hnum[:h]])
+        hhh = renderinlines(block[2])
+        if block[1] > 3:
+            hhh = escape("#" * (block[1] - 3)) + " " + hhh
+        return "\\{}section{{{}}}\n\\label{{s{}}}\n".format("sub" * (h - 1), hhh, hh)
+    if kind == "quote":
+        return "\\begin{quote}\n%s\\end{quote}\n" % renderinlines(block[1])
+    if kind == "pics":
+        return renderpics(block[1])
+    if kind == "equation":
         eqnum += 1
-        return "\\begin{align}\n%s\\end{align}\n" % (parsemath(s[2:]))
-    if s[:4] == "* [#":
-        # bibliography
-        return parsebib(s)
-    if s[:2] == "* ":
-        # list
-        return parseul(s, 1)
-    if s[:3] == "1. ":
-        # numbered list
-        return "\\begin{enumerate}\n%s\\end{enumerate}\n" % parseol(s)
-    if s[:2] == "| ":
-        # table
-        return parsetable(s)
-    if s[:3] == ":: ":
-        # big button
-        s = s[3:].rsplit(" ", 1)
+        return "\\begin{align}\n%s\\end{align}\n" % (parsemath(block[1]))
+    if kind == "list":
+        if isbib(block):
+            return renderbib(block)
+        return renderul(block)
+    if kind == "olist":
+        return "\\begin{enumerate}\n%s\\end{enumerate}\n" % "".join(
+            ["\\item %s\n" % renderinlines(item) for item in block[1]]
+        )
+    if kind == "table":
+        return rendertable(block)
+    if kind == "csv":
+        return rendercsv(block)
+    if kind == "button":
         return "\\begin{{center}}\\huge \\href{{{}}}{{{}}}\\end{{center}}\n".format(
-            s[1], s[0]
+            block[2], block[1]
         )
-    return "\\par %s\n" % (parsetext(s))
+    return "\\par %s\n" % (renderinlines(block[1]))
 
 
-def parsepics(s):
+def renderpics(pics):
     global fignum
-    lines = [ss[4:].split(None, 1) for ss in s.split("\n")]
     out = ""
-    for ss in lines:
+    for src, alt, caption, fullsize in pics:
         fignum += 1
-        ss[1] = ss[1].split(": ", 1)
-        pic = ss[0]
+        pic = src
         if pic[:4] == "http":
-            if not os.path.isfile(pic.split("/")[-1]):
-                os.system("wget %s" % pic)
-            pic = pic.split("/")[-1]
+            pic = fetched[pic]
         if pic[-4:] == ".svg":
             pic = pic[:-4] + ".pdf"
-        t = (pic, parsetext(ss[1][1]))
+        t = (pic, renderinlines(caption))
         out += (
             "\\begin{figure}[!htb]\n\\centering\n\\includegraphics[width=0.7\\columnwidth]{%s}\n\\caption{\\small %s}\n\\end{figure}\n"
             % t
@@ -158,105 +142,165 @@ def parsepics(s):
     return out
 
 
-def parseul(s, level):
-    s = "\n" + s
-    items = [ss.strip() for ss in ("\n" + s).split("\n" + "*" * level + " ")]
-    out = parsetext(items[0])
-    if len(items) > 1:
+def fetchpics(document, path="", workers=8):
+    # Downloads every remote figure of a document concurrently and returns a
+    # dict from URL to the downloaded file, relative to path.
+    urls = {
+        pic[0]
+        for block in document[2]
+        if block[0] == "pics"
+        for pic in block[1]
+        if pic[0][:4] == "http"
+    }
+    if not urls:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(min(workers, len(urls))) as pool:
+        return dict(zip(urls, pool.map(lambda url: fetch(url, path), urls)))
+
+
+def fetch(url, path=""):
+    # Figures are cached under a hash of the full URL, keeping the file
+    # extension for includegraphics. If the server sent an ETag, it is stored
+    # next to the file and used to revalidate it; otherwise a cached file is
+    # used as is. A cached file is also used if the server cannot be reached.
+    name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    name += os.path.splitext(urllib.parse.urlparse(url).path)[1]
+    filename = os.path.join(path, FIGCACHE, name)
+    etagfile = filename + ".etag"
+    headers = {}
+    if os.path.isfile(filename):
+        if not os.path.isfile(etagfile):
+            return os.path.join(FIGCACHE, name)
+        with open(etagfile) as f:
+            headers["If-None-Match"] = f.read()
+    try:
+        response = requests.get(url, headers=headers, timeout=60)
+        if response.status_code != 304:
+            response.raise_for_status()
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + ".tmp", "wb") as f:
+                f.write(response.content)
+            os.replace(filename + ".tmp", filename)
+            if "ETag" in response.headers:
+                with open(etagfile, "w") as f:
+                    f.write(response.headers["ETag"])
+            elif os.path.isfile(etagfile):
+                os.remove(etagfile)
+    except requests.RequestException as e:
+        sys.stderr.write(f"Figure error: {url}\n{e}\n")
+    return os.path.join(FIGCACHE, name)
+
+
+def renderul(block):
+    _, text, items = block
+    out = renderinlines(text)
+    if items:
         out += "\\begin{itemize}%s\\end{itemize}\n" % "".join(
-            ["\\item %s\n" % parseul(item, level + 1) for item in items[1:]]
+            ["\\item %s\n" % renderul(item) for item in items]
         )
     return out
 
 
-def parsebib(s):
-    return "\\begin{thebibliography}{99}\n%s\n\\end{thebibliography}" % "\n".join(
-        parsetext("[#" + ss.split("[#")[1]) for ss in s.split("\n*")
-    )
+def isbib(block):
+    # a bullet list whose first item starts with a reference [#name]
+    _, text, items = block
+    return not text and items and items[0][1][:1] and items[0][1][0][0] == "ref"
 
 
-def parseol(s):
-    return "".join(
-        ["\\item %s\n" % parsetext(ss) for ss in re.split("\n\\d+\\. ", s[2:])]
+def renderbib(block):
+    return "\\begin{thebibliography}{99}\n%s\n\\end{thebibliography}" % "\n".join(
+        [renderinlines(item[1]) for item in block[2]]
     )
 
 
-def parsetable(s):
+def rendertable(block):
     global tablenum
     tablenum += 1
-    rows = s.split("\n")
-    th = parseth(rows[0])
-    trows = "".join([parserow(row) for row in rows[1:-1]])
-    ccc = "c" * (len(rows[0]))
-    table = (ccc, th, trows, parsetext(rows[-1]), tablenum)
+    _, header, rows, caption = block
+    trows = "".join([renderrow(dllupast.parserow(row)) for row in rows])
+    table = (
+        "c" * len(header),
+        renderth(header),
+        trows,
+        renderinlines(caption),
+        tablenum,
+    )
     return (
         "\\begin{table}[!ht]\n\\centering\n\\begin{tabu}{%s}\n%s%s\\end{tabu}\n\\caption{%s}\n\\label{table%d}\\end{table}"
         % table
     )
 
 
-def parseth(s):
-    return "%s\\\\ \\hline\n" % " & ".join(
-        ["\\bf %s" % parsetext(th) for th in s.split("|") if th.strip() != ""]
-    )
-
-
-def parserow(s):
-    if re.match("^(\\||\\s|\\-)*$", s) is not None:
-        return ""
-    return "%s\\\\ \\hline\n" % " & ".join(
-        ["%s" % parsecell(td) for td in s.split("|") if td.strip() != ""]
-    )
-
-
-def parsecell(s):
-    if "\\n" in s:
-        cell_contents = "\\\\".join(parsetext(td) for td in s.split("\\n"))
-        return r"\begin{tabular}[]{@{}c@{}}" + cell_contents + r"\end{tabular}"
-    else:
-        return parsetext(s)
-
-
-def parsetext(s):
-    return splitparse(s.strip(), "`", lambda x: "\\texttt{%s}" % escape(x), parsetext2)
-
-
-def parsetext2(s):
-    return splitparse(s, "\\$", lambda x: "$%s$" % parsemath(x), parselink)
-
-
-def parselink(s):
-    return parseref(
-        re.sub(
-            "\\[([^\\]]+)\\]\\(([^)]+)\\)",
-            "\n~~~\n\\\\href{\\2}{\n~~~\n\\1\n~~~\n}\n~~~\n",
-            s,
-        )
+def rendercsv(block):
+    global tablenum
+    tablenum += 1
+    _, filename, caption = block
+    try:
+        with open(os.path.join(basepath, filename), newline="") as f:
+            reader = csv.reader(f)
+            header = [dllupast.parsecell(th) for th in next(reader, [])]
+            rows = [renderth(header)]
+            for row in reader:
+                rows.append(renderrow([dllupast.parsecell(td) for td in row]))
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        # like a failed equation, leave the table empty rather than stop
+        sys.stderr.write(f"Table error: {filename}\n{e}\n")
+        header, rows = [], []
+    ncols = max(1, len(header))
+    table = ("c" * ncols, "".join(rows), renderinlines(caption), tablenum)
+    return (
+        "\\begin{table}[!ht]\n\\centering\n\\begin{tabu}{%s}\n%s\\end{tabu}\n\\caption{%s}\n\\label{table%d}\\end{table}"
+        % table
     )
 
 
-def parseref(s):
-    return parsecite(re.sub("\\[\\#([^\\]]+)\\]", "\n~~~\n\\\\bibitem{\\1}\n~~~\n", s))
+def renderth(cells):
+    return "%s\\\\ \\hline\n" % " & ".join(["\\bf %s" % rendercell(th) for th in cells])
 
 
-def parsecite(s):
-    s = re.sub("\\(\\#([a-z]+)([0-9\\.]+)\\)", "\n~~~\n\\1~\\\\ref{\\1\\2}\n~~~\n", s)
-    s = re.sub("\\(\\#([^\\)]+)\\)", "\n~~~\n\\\\cite{\\1}\n~~~\n", s)
-    return parsespan(s)
+def renderrow(cells):
+    return "%s\\\\ \\hline\n" % " & ".join([rendercell(td) for td in cells])
 
 
-def parsespan(s):
-    return splitparse(s, "\n~~~\n", lambda x: x, parseem)
-
-
-def parseem(s):
-    return splitparse(s, "_", lambda x: "\\emph{%s}" % typographer(x), parsestrong)
+def rendercell(cell):
+    if len(cell) > 1:
+        cell_contents = "\\\\".join([renderinlines(line) for line in cell])
+        return r"\begin{tabular}[]{@{}c@{}}" + cell_contents + r"\end{tabular}"
+    return renderinlines(cell[0])
+
+
+def renderinlines(nodes):
+    return "".join([renderinline(node) for node in nodes])
+
+
+def renderinline(node):
+    kind = node[0]
+    if kind == "text":
+        return typographer(node[1])
+    if kind == "plain":
+        return escape(node[1])
+    if kind == "em":
+        return "\\emph{%s}" % typographer(node[1])
+    if kind == "strong":
+        return "\\textbf{%s}" % typographer(node[1])
+    if kind == "code":
+        return "\\texttt{%s}" % escape(node[1])
+    if kind == "math":
+        return "$%s$" % parsemath(node[1])
+    if kind == "link":
+        return "\\href{%s}{%s}" % (node[1], renderinlines(node[2]))
+    if kind == "ref":
+        return "\\bibitem{%s}" % node[1]
+    if kind == "cite":
+        # (#fig1) becomes fig~\ref{fig1}, anything else a citation
+        m = re.fullmatch("([a-z]+)([0-9\\.]+)", node[1])
+        if m is not None:
+            return "%s~\\ref{%s}" % (m[1], node[1])
+        return "\\cite{%s}" % node[1]
 
 
-def parsestrong(s):
-    return splitparse(
-        s, "\\*\\*", lambda x: "\\textbf{%s}" % typographer(x), typographer
-    )
+def parsetext(s):
+    return renderinlines(dllupast.parsetext(s))
 
 
 def typographer(s):
@@ -271,12 +315,10 @@ def parsemath(s):
     return s
 
 
-def highlight(s):
-    firstline = s.split("\n", 1)[0]
+def highlight(s, lang=None):
     output = "\\begin{lstlisting}"
-    if firstline[:5] == "lang ":
-        output += "[language=" + firstline[5:] + "]"
-        s = s.split("\n", 1)[1]
+    if lang is not None:
+        output += "[language=" + lang + "]"
     return output + "\n" + s + "\n\\end{lstlisting}\n"
 
 
@@ -287,9 +329,7 @@ def main():
             s += input() + "\n"
         except EOFError:
             break
-    print("% LaTeX document generated using dllup.")
-    print("% https://daniel.lawrence.lu/programming/dllup/")
-    print(parse(s))
+    print(HEADER + parse(s))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Builds PDFs of dllup documents with LaTeX.
+#
+#     dlluptexbuild.py [--tex xelatex] [-j N] path/to/paper [path/to/other ...]
+#
+# For each paper (path/to/paper.dllu without the extension), this renders the
+# markup to paper_dllu.tex, copies texheader.tex to paper.tex if there is none,
+# converts the SVG figures next to it and in its figure cache that have no up
+# to date PDF, and runs LaTeX. The second LaTeX pass only runs if the first
+# changed paper.aux. Figures are converted and papers are built in parallel.
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import dlluptex
+
+DLLUP = Path(__file__).resolve().parent
+
+
+def stale_svgs(folder: Path):
+    for svg in folder.glob("*.svg"):
+        pdf = svg.with_suffix(".pdf")
+        if not pdf.exists() or pdf.stat().st_mtime < svg.stat().st_mtime:
+            yield svg, pdf
+
+
+def svg2pdf(svg: Path, pdf: Path):
+    subprocess.run(
+        ["inkscape", "-z", "-f", svg.name, "-e", pdf.name],
+        cwd=svg.parent,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def body(paper: Path):
+    # The file that paper.tex inputs the rendered markup from. Headers copied
+    # before papers had their own body file input index_dllu.tex.
+    header = paper.with_suffix(".tex")
+    if header.exists() and "\\input{index_dllu.tex}" in header.read_text():
+        return paper.parent / "index_dllu.tex"
+    return paper.parent / f"{paper.name}_dllu.tex"
+
+
+def render(paper: Path):
+    # Writes the paper's body file, leaving it untouched if the output has not
+    # changed so that its mtime stays meaningful.
+    folder = paper.parent
+    with open(paper.with_suffix(".dllu")) as f:
+        tex = dlluptex.HEADER + dlluptex.parse(f.read(), folder)
+    if not paper.with_suffix(".tex").exists():
+        header = (DLLUP / "texheader.tex").read_text()
+        paper.with_suffix(".tex").write_text(
+            header.replace("index_dllu.tex", f"{paper.name}_dllu.tex")
+        )
+    output = body(paper)
+    if not output.exists() or output.read_text() != tex:
+        output.write_text(tex)
+
+
+def digest(path: Path):
+    try:
+        return hashlib.sha1(path.read_bytes()).digest()
+    except FileNotFoundError:
+        return None
+
+
+def latex(paper: Path, tex="xelatex"):
+    # Runs LaTeX once, and a second time only if the first run changed the aux
+    # file (labels, references and the like).
+    aux = paper.with_suffix(".aux")
+    for _ in range(2):
+        before = digest(aux)
+        p = subprocess.run(
+            [tex, "-halt-on-error", paper.with_suffix(".tex").name],
+            cwd=paper.parent,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if p.returncode != 0:
+            sys.stdout.write(p.stdout.decode("utf-8", "replace"))
+            raise RuntimeError(f"{tex} failed on {paper}.tex")
+        if digest(aux) == before:
+            break
+
+
+def build(paper: Path, figures, tex="xelatex"):
+    # figures are the conversions of the SVGs in the paper's folder, which run
+    # in their own executor so that papers waiting on them cannot starve it.
+    for future in figures:
+        future.result()
+    latex(paper, tex)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds PDFs of dllup documents.")
+    parser.add_argument("papers", nargs="+", type=Path, help="paths without .dllu")
+    parser.add_argument("--tex", default="xelatex", help="LaTeX engine")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    papers = [p.with_suffix("") if p.suffix == ".dllu" else p for p in args.papers]
+
+    # papers sharing a body file would overwrite each other's
+    bodies = {}
+    for paper in papers:
+        other = bodies.setdefault(body(paper).resolve(), paper)
+        if other != paper:
+            sys.exit(
+                f"{other} and {paper} both input {body(paper)}; change the "
+                f"\\input in {paper}.tex to {paper.name}_dllu.tex"
+            )
+
+    # dlluptex keeps its state in globals, so render one paper at a time
+    for paper in papers:
+        render(paper)
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(
+        args.jobs
+    ) as converter, concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+        # papers in the same folder share their figures
+        figures = {}
+        for folder in {p.parent for p in papers}:
+            figures[folder] = [
+                converter.submit(svg2pdf, *f)
+                for d in (folder, folder / dlluptex.FIGCACHE)
+                for f in stale_svgs(d)
+            ]
+        futures = {
+            pool.submit(build, p, figures[p.parent], args.tex): p for p in papers
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                print(f"built {futures[future]}.pdf")
+            except (RuntimeError, subprocess.CalledProcessError) as e:
+                print(e, file=sys.stderr)
+                failed += 1
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# Writes the sitemap and the RSS and Atom feeds of blogposts folders, from the
+# pages and folder data the build already has. Both need absolute urls, so
+# nothing is written unless the top level config gives the site's url.
+#
+# The XML is streamed to disk, and a file whose content did not change is left
+# alone (see writer.stream).
+#
+# Every url of the sitemap keeps its place in an sqlite database, as the number
+# of the urlset file it is listed in. New urls are appended to the last urlset,
+# and only the urlsets that gained, lost or updated a url are rewritten.
+
+import email.utils
+import html
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from xml.sax.saxutils import XMLGenerator
+
+import writer
+
+# the limit set by the sitemap protocol
+SITEMAP_URLS = 50000
+FEED_ENTRIES = 20
+
+# the site's author, as in html/head.html; atom feeds must name one
+AUTHOR = "Daniel Lawrence Lu"
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+base = None
+db = None
+# the last urlset and its number of urls
+last = 1
+count = 0
+# the urlsets to rewrite
+dirty = set()
+
+tags = re.compile("<[^>]*>")
+
+
+def start(url, path="sitemap.db"):
+    # url is the scheme and host of the site, eg https://daniel.lawrence.lu
+    global base, db, last, count
+    base = url.rstrip("/") if url else None
+    dirty.clear()
+    if base is None:
+        return
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE IF NOT EXISTS urls
+                  (url TEXT PRIMARY KEY, urlset INTEGER, lastmod TEXT, seen INTEGER)""")
+    db.execute("CREATE TABLE IF NOT EXISTS site (base TEXT)")
+    if db.execute("SELECT base FROM site").fetchone() != (base,):
+        # every loc changes with the site's url
+        db.execute("DELETE FROM site")
+        db.execute("INSERT INTO site VALUES (?)", (base,))
+        dirty.update(u for (u,) in db.execute("SELECT DISTINCT urlset FROM urls"))
+    db.execute("UPDATE urls SET seen = 0")
+    last, count = db.execute(
+        "SELECT urlset, COUNT(*) FROM urls GROUP BY urlset ORDER BY urlset DESC"
+    ).fetchone() or (1, 0)
+
+
+def add_page(url, mtime):
+    global last, count
+    if db is None:
+        return
+    lastmod = time.strftime("%Y-%m-%d", time.gmtime(mtime))
+    row = db.execute(
+        "SELECT urlset, lastmod FROM urls WHERE url = ?", (url,)
+    ).fetchone()
+    if row is None:
+        if count >= SITEMAP_URLS:
+            last, count = last + 1, 0
+        count += 1
+        db.execute("INSERT INTO urls VALUES (?, ?, ?, 1)", (url, last, lastmod))
+        dirty.add(last)
+        return
+    urlset, old = row
+    db.execute("UPDATE urls SET lastmod = ?, seen = 1 WHERE url = ?", (lastmod, url))
+    if old != lastmod:
+        dirty.add(urlset)
+
+
+def text(s):
+    # folder titles and subtitles are rendered html
+    return html.unescape(tags.sub("", s)).strip()
+
+
+def element(xml, name, content=None, attrs={}):
+    xml.startElement(name, attrs)
+    if content is not None:
+        xml.characters(content)
+    xml.endElement(name)
+
+
+def write_sitemap(output=Path()):
+    # Drops the urls the build did not visit, then writes the urlsets that
+    # changed and the index of all of them.
+    global db
+    if db is None:
+        return
+    dirty.update(
+        u for (u,) in db.execute("SELECT DISTINCT urlset FROM urls WHERE seen = 0")
+    )
+    db.execute("DELETE FROM urls WHERE seen = 0")
+    urlsets = db.execute(
+        "SELECT urlset, MAX(lastmod) FROM urls GROUP BY urlset ORDER BY urlset"
+    ).fetchall()
+    with writer.stream(output / "sitemap.xml") as f:
+        xml = XMLGenerator(f, "utf-8", short_empty_elements=True)
+        xml.startDocument()
+        xml.startElement("sitemapindex", {"xmlns": SITEMAP_NS})
+        for urlset, lastmod in urlsets:
+            name = f"sitemap-{urlset}.xml"
+            if urlset in dirty or not (output / name).exists():
+                write_urlset(output / name, urlset)
+            xml.startElement("sitemap", {})
+            element(xml, "loc", f"{base}/{name}")
+            element(xml, "lastmod", lastmod)
+            xml.endElement("sitemap")
+        xml.endElement("sitemapindex")
+        xml.endDocument()
+    db.commit()
+    db.close()
+    db = None
+    numbers = {str(urlset) for urlset, _ in urlsets}
+    for old in output.glob("sitemap-*.xml*"):
+        if old.name[len("sitemap-") :].split(".")[0] not in numbers:
+            old.unlink()
+
+
+def write_urlset(path, urlset):
+    with writer.stream(path) as f:
+        xml = XMLGenerator(f, "utf-8", short_empty_elements=True)
+        xml.startDocument()
+        xml.startElement("urlset", {"xmlns": SITEMAP_NS})
+        for url, lastmod in db.execute(
+            "SELECT url, lastmod FROM urls WHERE urlset = ? ORDER BY rowid", (urlset,)
+        ):
+            xml.startElement("url", {})
+            element(xml, "loc", base + url)
+            element(xml, "lastmod", lastmod)
+            xml.endElement("url")
+        xml.endElement("urlset")
+        xml.endDocument()
+
+
+def write_feeds(path, root, title, folderdata):
+    # Writes rss.xml and atom.xml for a blogposts folder. folderdata is the
+    # navigation data of its posts, newest first, with root relative links.
+    if base is None:
+        return
+    link = f"{base}{root}/" if path == Path() else f"{base}{root}/{path}/"
+    entries = []
+    for f in folderdata[:FEED_ENTRIES]:
+        date = datetime.strptime(f["date"], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        entries.append(
+            (
+                f"{base}{root}{f['child']}/",
+                text(f.get("title", f["child_name"])),
+                text(f.get("subtitle", "")),
+                date,
+            )
+        )
+    updated = entries[0][3] if entries else datetime.fromtimestamp(0, timezone.utc)
+
+    with writer.stream(path / "rss.xml") as f:
+        xml = XMLGenerator(f, "utf-8", short_empty_elements=True)
+        xml.startDocument()
+        xml.startElement("rss", {"version": "2.0"})
+        xml.startElement("channel", {})
+        element(xml, "title", title)
+        element(xml, "link", link)
+        element(xml, "description", title)
+        element(xml, "lastBuildDate", email.utils.format_datetime(updated))
+        for url, entry_title, summary, date in entries:
+            xml.startElement("item", {})
+            element(xml, "title", entry_title)
+            element(xml, "link", url)
+            element(xml, "guid", url)
+            element(xml, "pubDate", email.utils.format_datetime(date))
+            if summary:
+                element(xml, "description", summary)
+            xml.endElement("item")
+        xml.endElement("channel")
+        xml.endElement("rss")
+        xml.endDocument()
+
+    with writer.stream(path / "atom.xml") as f:
+        xml = XMLGenerator(f, "utf-8", short_empty_elements=True)
+        xml.startDocument()
+        xml.startElement("feed", {"xmlns": ATOM_NS})
+        element(xml, "title", title)
+        element(xml, "id", link)
+        element(xml, "link", attrs={"href": link})
+        element(xml, "link", attrs={"rel": "self", "href": f"{link}atom.xml"})
+        element(xml, "updated", updated.isoformat())
+        xml.startElement("author", {})
+        element(xml, "name", AUTHOR)
+        xml.endElement("author")
+        for url, entry_title, summary, date in entries:
+            xml.startElement("entry", {})
+            element(xml, "title", entry_title)
+            element(xml, "id", url)
+            element(xml, "link", attrs={"href": url})
+            element(xml, "updated", date.isoformat())
+            if summary:
+                element(xml, "summary", summary)
+            xml.endElement("entry")
+        xml.endElement("feed")
+        xml.endDocument()
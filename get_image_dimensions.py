@@ -1,3 +1,5 @@
+import os
+import profiling
 import requests
 from PIL import Image
 from io import BytesIO
@@ -21,6 +23,14 @@ def get_image_size(image_path):
     return image.size
 
 
+def get_mtime(path):
+    """Get the modification time of a local file, or None for a URL."""
+    if is_url(path):
+        return None
+    return os.path.getmtime(path)
+
+
+@profiling.timed("dimension lookup")
 def get_image_dimensions(path, db_path="/tmp/img_size_db.db"):
     """Get the dimensions of an image from a URL or local path, with caching."""
     # Connect to SQLite database
@@ -28,30 +38,34 @@ def get_image_dimensions(path, db_path="/tmp/img_size_db.db"):
     cursor = conn.cursor()
 
     # Create table if it doesn't exist
+    cursor.execute("""CREATE TABLE IF NOT EXISTS image_cache
+                      (path TEXT PRIMARY KEY, width INTEGER, height INTEGER)""")
+    # Caches made before local files were checked for changes have no mtime
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(image_cache)")]
+    if "mtime" not in columns:
+        cursor.execute("ALTER TABLE image_cache ADD COLUMN mtime REAL")
+
+    # Check if the path is already in the cache, and unchanged if it is a file
+    mtime = get_mtime(path)
     cursor.execute(
-        """CREATE TABLE IF NOT EXISTS image_cache
-                      (path TEXT PRIMARY KEY, width INTEGER, height INTEGER)"""
+        "SELECT width, height, mtime FROM image_cache WHERE path = ?", (path,)
     )
-
-    # Check if the path is already in the cache
-    cursor.execute("SELECT width, height FROM image_cache WHERE path = ?", (path,))
     result = cursor.fetchone()
 
-    if result:
+    if result and result[2] == mtime:
         # If the path is in the cache, return the cached dimensions
-        width, height = result
-        print(f"Retrieved from cache: Width = {width}, Height = {height}")
+        width, height, _ = result
     else:
-        # If the path is not in the cache, fetch the image and calculate its dimensions
+        # Otherwise fetch the image and calculate its dimensions
         width, height = get_image_size(path)
 
         # Save the new dimensions to the cache
         cursor.execute(
-            "INSERT INTO image_cache (path, width, height) VALUES (?, ?, ?)",
-            (path, width, height),
+            "INSERT OR REPLACE INTO image_cache (path, width, height, mtime) "
+            "VALUES (?, ?, ?, ?)",
+            (path, width, height, mtime),
         )
         conn.commit()
-        print(f"Fetched and cached: Width = {width}, Height = {height}")
 
     # Close the database connection
     conn.close()
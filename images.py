@@ -0,0 +1,153 @@
+# Makes resized copies of the raster images of the site, in several widths and
+# formats, for the srcset of figures (see dllup.renderpics).
+#
+# An image foo.png that is W pixels wide gets
+#
+#     foo_<w><ext>      for each w in widths narrower than W, and for W itself,
+#                       in each ext of formats and in the image's own format
+#                       (except foo_<W>.png, which is just foo.png)
+#     foo_600.png       600 pixels wide, the fallback for browsers without
+#     foo_600@2x.png    srcset, and 1200 pixels wide, as before
+#
+# widths and formats can be set in the top level config, eg
+#
+#     widths 400 800 1600
+#     formats webp
+#
+# Formats that Pillow was built without are ignored. Copies are made only when
+# missing or older than the image, in a thread pool since Pillow releases the
+# GIL while resizing and encoding.
+
+import concurrent.futures
+import os
+import re
+from pathlib import Path
+
+from PIL import Image, features
+
+import profiling
+
+# Pillow format and mime type of each extension
+TYPES = {
+    ".png": ("PNG", "image/png"),
+    ".jpg": ("JPEG", "image/jpeg"),
+    ".webp": ("WEBP", "image/webp"),
+    ".avif": ("AVIF", "image/avif"),
+}
+
+widths = (600, 1200)
+# best first, as browsers use the first <source> they support
+formats = tuple(ext for ext in (".avif", ".webp") if features.check(ext[1:]))
+
+pool = None
+futures = {}
+
+copy = re.compile("_(\\d+)(@2x)?$")
+
+
+def configure(widths_config=None, formats_config=None):
+    global widths, formats
+    if widths_config:
+        widths = tuple(sorted(int(w) for w in widths_config.split()))
+    if formats_config:
+        formats = tuple(
+            f".{f}"
+            for f in formats_config.split()
+            if f".{f}" in TYPES and features.check(f)
+        )
+
+
+def is_copy(path: Path):
+    # Whether path is one of the copies made of another image in its own
+    # format, so that eg fig_1.png next to fig.png is still an image of its own.
+    m = copy.search(path.stem)
+    if m is None:
+        return False
+    width = int(m.group(1))
+    if m.group(2) is not None:
+        if width != 600:
+            return False
+    elif width != 600 and width not in widths:
+        return False
+    return path.with_name(path.stem[: m.start()] + path.suffix).exists()
+
+
+def name(src, width, ext):
+    # The copy of the image at src (a path or url) that is width pixels wide.
+    return f"{os.path.splitext(src)[0]}_{width}{ext}"
+
+
+def srcset_widths(width):
+    return [w for w in widths if w < width] + [width]
+
+
+def copies(path: Path, width):
+    # (path, width) of every copy to make of an image that is width pixels wide
+    out = {}
+    for w in srcset_widths(width):
+        for ext in (path.suffix,) + formats:
+            if ext != path.suffix or w != width:
+                out[Path(name(path, w, ext))] = w
+    out[Path(name(path, 600, path.suffix))] = 600
+    out[path.with_name(f"{path.stem}_600@2x{path.suffix}")] = 1200
+    return out.items()
+
+
+def start(workers=None):
+    global pool
+    pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+
+def submit(path: Path):
+    if pool is None:
+        resize(path)
+    else:
+        futures[path] = pool.submit(resize, path)
+
+
+def wait(path: Path):
+    # Waits until the copies of the image that path is a copy of are made.
+    m = copy.search(path.stem)
+    if m is not None:
+        path = path.with_name(path.stem[: m.start()] + path.suffix)
+    if path in futures:
+        concurrent.futures.wait([futures[path]])
+
+
+def finish():
+    # Waits for all copies. A broken image is reported but does not stop the
+    # build, like a failed gm convert used to.
+    global pool, futures
+    pool.shutdown(wait=True)
+    done, futures, pool = futures, {}, None
+    for path, future in done.items():
+        try:
+            future.result()
+        except OSError as e:
+            print(f"could not resize {path}: {e}")
+
+
+@profiling.timed("image resize")
+def resize(path: Path):
+    mtime = path.stat().st_mtime
+    with Image.open(path) as image:
+        stale = [
+            (out, w)
+            for out, w in copies(path, image.width)
+            if not out.exists() or out.stat().st_mtime < mtime
+        ]
+        if not stale:
+            return
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        for out, w in stale:
+            h = max(1, round(image.height * w / image.width))
+            save(image.resize((w, h), Image.LANCZOS), out)
+
+
+def save(image, out: Path):
+    if out.suffix == ".jpg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    tmp = out.with_name(f".{out.name}.tmp")
+    image.save(tmp, TYPES[out.suffix][0])
+    os.replace(tmp, out)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+import dllup
+import dllupast
+import images
+import profiling
+
+db = None
+limit = 0
+
+
+def open_cache(path="parse_cache.db", size=256 * 2**20):
+    # Opens the cache of rendered page bodies. Entries beyond size bytes are
+    # evicted, least recently used first, when the cache is closed.
+    global db, limit
+    db = sqlite3.connect(path)
+    limit = size
+    db.execute("""CREATE TABLE IF NOT EXISTS parse_cache
+                  (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)""")
+
+
+def close_cache():
+    global db
+    total = db.execute("SELECT COALESCE(SUM(size), 0) FROM parse_cache").fetchone()[0]
+    if total > limit:
+        evict = []
+        for key, size in db.execute("SELECT key, size FROM parse_cache ORDER BY used"):
+            if total <= limit:
+                break
+            evict.append((key,))
+            total -= size
+        db.executemany("DELETE FROM parse_cache WHERE key = ?", evict)
+    db.commit()
+    db.close()
+    db = None
+
+
+def cache_key(markup, path, root):
+    # The rendered body only depends on the markup, the directory it is in
+    # (for external files), the site root its urls are prefixed with, the
+    # parser version, the image copies that figures
+    # link to, which equations are inlined and the files recorded in
+    # dllup.dependencies, which are checked separately.
+    options = (dllupast.VERSION, images.widths, images.formats, dllup.inline_svg)
+    return hashlib.sha1(
+        f"{options}\0{path}\0{root}\0{markup}".encode("utf-8")
+    ).hexdigest()
+
+
+def getmtime(filename):
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+
+def fresh(dependencies):
+    # A missing file is never fresh, so failed math renders are retried.
+    return all(
+        mtime is not None and getmtime(filename) == mtime
+        for filename, mtime in dependencies
+    )
+
+
+def up_to_date(markup, path, root):
+    # Whether every file the cached body depends on is unchanged, for pages
+    # whose markup, templates and navigation are. A page that is not in the
+    # cache counts as changed, since its dependencies are unknown.
+    if db is None:
+        return True
+    key = cache_key(markup, path, root)
+    row = db.execute("SELECT value FROM parse_cache WHERE key = ?", (key,)).fetchone()
+    return row is not None and fresh(pickle.loads(row[0])[2])
+
+
+def store(markup, path, root, output, metas):
+    # Caches a body just rendered by dllup and prefixed with root (see
+    # dllup.rootify), with the files it read.
+    dependencies = [(f, getmtime(f)) for f in set(dllup.dependencies)]
+    value = pickle.dumps((output, metas, dependencies), pickle.HIGHEST_PROTOCOL)
+    db.execute(
+        "INSERT OR REPLACE INTO parse_cache VALUES (?, ?, ?, ?)",
+        (cache_key(markup, path, root), value, len(value), time.time()),
+    )
+
+
+def render(markup, path, root=""):
+    # Returns (body_html, metas) like dllup.parse, with root-relative urls
+    # prefixed with root, reusing a cached result when the markup and every
+    # file it depends on are unchanged. As the cached body is already
+    # prefixed, a cache hit never has to copy it.
+    if db is None:
+        output, metas = dllup.parse(markup, path)
+        return dllup.rootify(output, root), metas
+    key = cache_key(markup, path, root)
+    row = db.execute("SELECT value FROM parse_cache WHERE key = ?", (key,)).fetchone()
+    if row is not None:
+        output, metas, dependencies = pickle.loads(row[0])
+        if fresh(dependencies):
+            profiling.count("parse cache hit")
+            db.execute(
+                "UPDATE parse_cache SET used = ? WHERE key = ?", (time.time(), key)
+            )
+            return output, metas
+    profiling.count("parse cache miss")
+    output, metas = dllup.parse(markup, path)
+    output = dllup.rootify(output, root)
+    store(markup, path, root, output, metas)
+    return output, metas
@@ -0,0 +1,79 @@
+import collections
+import contextlib
+import functools
+import json
+import threading
+import time
+
+# stage name -> [total wall time in seconds, number of calls]
+stages = collections.defaultdict(lambda: [0.0, 0])
+# event name -> count, e.g. math cache hits and misses
+counters = collections.Counter()
+# page path -> wall time in seconds spent building it
+pages = {}
+
+# stages also run in the worker threads of images and writer
+lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def stage(name):
+    # Accumulates the wall time spent inside the block under the given name.
+    # Stages may nest or run in several threads at once, so their times do not
+    # necessarily add up.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with lock:
+            s = stages[name]
+            s[0] += seconds
+            s[1] += 1
+
+
+def timed(name):
+    # Decorator version of stage.
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    counters[name] += n
+
+
+def page(name, seconds):
+    pages[str(name)] = seconds
+
+
+def report():
+    return {
+        "stages": {k: {"seconds": v[0], "calls": v[1]} for k, v in stages.items()},
+        "counters": dict(counters),
+        "pages": pages,
+    }
+
+
+def write_report(path):
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+
+
+def print_summary(n=10):
+    for name, (seconds, calls) in sorted(
+        stages.items(), key=lambda kv: kv[1][0], reverse=True
+    ):
+        print(f"{seconds:9.3f}s {calls:7d}x  {name}")
+    for name, value in sorted(counters.items()):
+        print(f"{value:18d}  {name}")
+    if pages:
+        print(f"slowest {min(n, len(pages))} pages:")
+        for name, seconds in sorted(pages.items(), key=lambda kv: kv[1])[::-1][:n]:
+            print(f"{seconds:9.3f}s  {name}")
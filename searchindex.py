@@ -0,0 +1,132 @@
+# Builds a client-side search index from the titles, descriptions and section
+# headers of the pages, as the build renders them.
+#
+# The index is written to search/ as
+#
+#     pages.json     [[url, title], ...] indexed by page id; removed pages are null
+#     <prefix>.bin   the postings of every term starting with prefix
+#
+# where prefix is the hex of the utf-8 encoding of the first PREFIX characters
+# of the term, so the browser only fetches the shard for what is typed. A shard
+# is a sequence of records, sorted by term,
+#
+#     varint len(term), term (utf-8), varint n, n varints
+#
+# where the n varints are the ids of the pages containing the term, in
+# increasing order, each stored as the difference from the previous one.
+# Varints are little endian base 128, the high bit set on all but the last byte.
+#
+# The terms of each page are kept in an sqlite database, so pages the build
+# skips keep their entries and ids stay stable between builds. Only shards whose
+# content changed are rewritten.
+
+import html
+import json
+import re
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+
+import writer
+
+PREFIX = 2
+
+db = None
+folder = None
+seen = set()
+
+tags = re.compile("<[^>]*>")
+words = re.compile("[^\\W_]+")
+
+
+def open_index(output="search", path="search_index.db"):
+    global db, folder
+    db = sqlite3.connect(path)
+    folder = Path(output)
+    seen.clear()
+    db.execute("""CREATE TABLE IF NOT EXISTS pages
+                  (id INTEGER PRIMARY KEY, url TEXT UNIQUE, title TEXT, terms TEXT)""")
+
+
+def indexed(url):
+    # Whether the page is in the index, so the build can skip rendering it.
+    # Always true when there is no index to build.
+    if db is None:
+        return True
+    if db.execute("SELECT 1 FROM pages WHERE url = ?", (url,)).fetchone() is None:
+        return False
+    seen.add(url)
+    return True
+
+
+def tokenize(s):
+    return words.findall(html.unescape(tags.sub(" ", s)).lower())
+
+
+def add(url, title, metas):
+    if db is None:
+        return
+    terms = set(tokenize(title))
+    terms.update(tokenize(metas.get("description", "")))
+    for entry in metas.get("toc", []):
+        terms.update(tokenize(entry["title"]))
+    seen.add(url)
+    db.execute(
+        """INSERT INTO pages (url, title, terms) VALUES (?, ?, ?)
+           ON CONFLICT (url) DO UPDATE SET title = excluded.title,
+                                           terms = excluded.terms""",
+        (url, title.split("\n", 1)[0], " ".join(sorted(terms))),
+    )
+
+
+def varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def shard(postings):
+    out = bytearray()
+    for term in sorted(postings):
+        encoded = term.encode("utf-8")
+        out += varint(len(encoded))
+        out += encoded
+        out += varint(len(postings[term]))
+        previous = 0
+        for page in postings[term]:
+            out += varint(page - previous)
+            previous = page
+    return bytes(out)
+
+
+def close_index():
+    # Drops the pages the build did not visit and writes the shards that changed.
+    global db
+    stale = [
+        (url,) for (url,) in db.execute("SELECT url FROM pages") if url not in seen
+    ]
+    db.executemany("DELETE FROM pages WHERE url = ?", stale)
+
+    pages = []
+    shards = defaultdict(lambda: defaultdict(list))
+    for id, url, title, terms in db.execute(
+        "SELECT id, url, title, terms FROM pages ORDER BY id"
+    ):
+        pages.extend([None] * (id - len(pages)))
+        pages.append([url, title])
+        for term in terms.split():
+            shards[term[:PREFIX].encode("utf-8").hex()][term].append(id)
+    db.commit()
+    db.close()
+    db = None
+
+    folder.mkdir(exist_ok=True)
+    writer.write(folder / "pages.json", [json.dumps(pages, ensure_ascii=False)])
+    for prefix, postings in shards.items():
+        writer.write(folder / f"{prefix}.bin", [shard(postings)])
+    for old in folder.glob("*.bin*"):
+        if old.name.split(".")[0] not in shards:
+            old.unlink()
@@ -0,0 +1,148 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import zlib
+from pathlib import Path
+
+import profiling
+
+# brotli and zstandard are optional; without them only .gz files are written
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+pool = None
+futures = []
+
+
+def encodings():
+    # (suffix, function returning a compressor with compress and flush methods)
+    out = [(".gz", gzipcompressor)]
+    if brotli is not None:
+        out.append((".br", brotlicompressor))
+    if zstandard is not None:
+        out.append((".zst", zstandard.ZstdCompressor(level=19).compressobj))
+    return out
+
+
+def gzipcompressor():
+    # wbits 31 writes a gzip header with no timestamp, so output is reproducible
+    return zlib.compressobj(9, zlib.DEFLATED, 31)
+
+
+class brotlicompressor:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=11)
+
+    def compress(self, chunk):
+        return self.compressor.process(chunk)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def start(workers=None):
+    global pool
+    pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+
+def finish():
+    # Waits for all compression jobs, raising the first error if any failed.
+    global pool, futures
+    pool.shutdown(wait=True)
+    done, futures, pool = futures, [], None
+    for future in done:
+        future.result()
+
+
+def replace(path: Path, chunks):
+    # Writes to a temporary file and renames it over path, so that readers
+    # never see a partially written file.
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.writelines(chunks)
+    os.replace(tmp, path)
+
+
+def digest(chunks):
+    h = hashlib.sha1()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.digest()
+
+
+def filedigest(path: Path):
+    try:
+        with open(path, "rb") as f:
+            return digest(iter(lambda: f.read(1 << 16), b""))
+    except FileNotFoundError:
+        return None
+
+
+@profiling.timed("compress")
+def compress(path: Path, chunks=None):
+    # Writes a compressed sibling of path for every available encoding.
+    if chunks is None:
+        chunks = [path.read_bytes()]
+    for suffix, compressor in encodings():
+        c = compressor()
+        out = [c.compress(chunk) for chunk in chunks]
+        out.append(c.flush())
+        replace(path.with_name(path.name + suffix), out)
+
+
+def compressed(path: Path):
+    # Whether every compressed sibling exists and is at least as new as path.
+    mtime = path.stat().st_mtime
+    for suffix, _ in encodings():
+        sibling = path.with_name(path.name + suffix)
+        if not sibling.exists() or sibling.stat().st_mtime < mtime:
+            return False
+    return True
+
+
+def write(path, chunks):
+    # Writes a generated file given as a list of str or bytes chunks, then
+    # compresses it in the background. Nothing is written when the content is
+    # unchanged and the compressed files are up to date. Returns whether the
+    # file changed.
+    path = Path(path)
+    chunks = [c.encode("utf-8") if isinstance(c, str) else c for c in chunks]
+    if digest(chunks) == filedigest(path) and compressed(path):
+        return False
+    replace(path, chunks)
+    submit(path, chunks)
+    return True
+
+
+@contextlib.contextmanager
+def stream(path):
+    # Like write, for output produced bit by bit into a binary file object.
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            yield f
+    except BaseException:
+        os.remove(tmp)
+        raise
+    if filedigest(tmp) == filedigest(path) and compressed(path):
+        os.remove(tmp)
+        return
+    os.replace(tmp, path)
+    submit(path)
+
+
+def submit(path, chunks=None):
+    # Compresses path in the background if a pool was started, or right away.
+    path = Path(path)
+    if pool is None:
+        compress(path, chunks)
+    else:
+        futures.append(pool.submit(compress, path, chunks))